@@ -185,7 +185,7 @@ After=network.target
 Type=simple
 User=root
 WorkingDirectory=/srv/pos_system/server
-ExecStart=/usr/bin/python3 /srv/pos_system/server/app.py
+ExecStart=/usr/bin/python3 /srv/pos_system/server/serve.py
 Restart=always
 
 [Install]
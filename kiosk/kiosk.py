@@ -1,16 +1,222 @@
+import time
+STARTED = time.perf_counter()  # before the other imports, so the first-frame log includes them
 import tkinter as tk
 from tkinter import messagebox, simpledialog
-import requests
 import threading
-import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import socket
 import logging
-from werkzeug.security import check_password_hash
-import nfc  # For RFID/NFC reading
+import os
+import json
+import sqlite3
+import uuid
+import random
+import bisect
+from datetime import datetime
+from urllib.parse import quote
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+CACHE_DIR = os.environ.get('POS_KIOSK_CACHE_DIR', os.path.expanduser('~/.pos_kiosk'))
+CATALOG_CACHE_FILE = os.path.join(CACHE_DIR, 'catalog.json')
+JOURNAL_FILE = os.path.join(CACHE_DIR, 'journal.db')
+SERVER_CACHE_FILE = os.path.join(CACHE_DIR, 'server.json')
+DISCOVERY_TIMEOUTS = (1, 2, 2)
+DISCOVERY_JITTER = 0.5
+SYNC_BATCH_SIZE = 50
+SYNC_MAX_BACKOFF = 60
+REQUEST_TIMEOUT = (3, 10)  # connect, read
+KIOSK_ID = int(os.environ.get('POS_KIOSK_ID', '1'))
+HEARTBEAT_INTERVAL = 15
+CATALOG_REFRESH_MS = 60 * 1000  # background catalog revalidation, so sell-outs reach the grid; a 304 when unchanged
+IO_WORKERS = 4
+RESULT_POLL_MS = 50
+GRID_COLUMNS = 4
+GRID_ROWS = 3
+ALL_CATEGORIES = 'All'
+OTHER_CATEGORY = 'Other'
+STARTUP_PROBE = os.environ.get('POS_KIOSK_STARTUP_PROBE') == '1'  # print time to first frame and exit; see server/bench_startup.py
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+def read_json_file(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def decode_table(table):
+    # msgpack tables arrive column-oriented ({'columns', 'values'}); JSON ones are already a list of objects
+    if isinstance(table, dict):
+        return [dict(zip(table['columns'], row)) for row in zip(*table['values'])]
+    return table
+
+def write_json_file(path, data):
+    # Write then rename so a power cut never leaves a half-written cache
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class SaleJournal:
+    # Durable queue of completed sales: a sale is on disk before the till reports success
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, payload TEXT NOT NULL, created TEXT NOT NULL, rejected TEXT)')
+
+    def append(self, order):
+        order['idempotency_key'] = order.get('idempotency_key') or uuid.uuid4().hex
+        order['timestamp'] = order.get('timestamp') or datetime.utcnow().isoformat()
+        with self.lock:
+            self.conn.execute('INSERT INTO journal (key, payload, created) VALUES (?, ?, ?)', (order['idempotency_key'], json.dumps(order), order['timestamp']))
+        return order['idempotency_key']
+
+    def pending(self, limit):
+        with self.lock:
+            rows = self.conn.execute('SELECT payload FROM journal WHERE rejected IS NULL ORDER BY id LIMIT ?', (limit,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def depth(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM journal WHERE rejected IS NULL').fetchone()[0]
+
+    def acknowledge(self, keys):
+        with self.lock:
+            self.conn.executemany('DELETE FROM journal WHERE key = ?', [(key,) for key in keys])
+
+    def reject(self, key, error):
+        # Kept on disk for staff to inspect, but no longer retried
+        with self.lock:
+            self.conn.execute('UPDATE journal SET rejected = ? WHERE key = ?', (error, key))
+
+class CatalogIndex:
+    # Sorted (word, position) pairs over item names and SKUs, so type-ahead is a bisect per keystroke
+    # on the kiosk rather than a scan or a server round trip; SKUs also map straight to items for scanning
+    def __init__(self, items):
+        self.items = items
+        self.by_sku = {item['sku']: item for item in items if item.get('sku')}
+        self.words = sorted((word, position) for position, item in enumerate(items)
+                            for word in set(item['name'].lower().split() + [(item.get('sku') or '').lower()]) if word)
+        self.keys = [word for word, _ in self.words]
+
+    def prefix_matches(self, term):
+        matches = set()
+        for i in range(bisect.bisect_left(self.keys, term), len(self.keys)):
+            if not self.keys[i].startswith(term):
+                break
+            matches.add(self.words[i][1])
+        return matches
+
+    def search(self, text):
+        terms = text.lower().split()
+        if not terms:
+            return self.items
+        positions = set.intersection(*(self.prefix_matches(term) for term in terms))
+        return [self.items[position] for position in sorted(positions)]
+
+class ServerUnreachable(Exception):
+    # No response at all (connection refused, timed out, not discovered yet), as opposed to an error response
+    pass
+
+class ServerClient:
+    # All server I/O runs on a worker pool over one keep-alive session; results come back on the Tk thread
+    def __init__(self, root, workers=IO_WORKERS):
+        self.root = root
+        self.base_url = None
+        self.ready = threading.Event()
+        self.workers = workers
+        self.http = None
+        self.http_lock = threading.Lock()
+        self.token = None
+        self.msgpack_ok = False
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='server-io')
+        self.results = queue.Queue()
+        self.root.after(RESULT_POLL_MS, self.deliver_results)
+
+    def set_base_url(self, url):
+        self.base_url = url
+        self.ready.set()
+
+    def reset(self):
+        self.ready.clear()
+
+    @property
+    def session(self):
+        # requests is the kiosk's heaviest import, so it loads with the first request on an I/O worker, after the first frame
+        with self.http_lock:
+            if self.http is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers + 1)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if msgpack:
+                    # The server answers list endpoints in msgpack when asked; anything else stays JSON
+                    session.headers['Accept'] = f'{MSGPACK_MIMETYPE}, application/json;q=0.9'
+                self.http = session
+            return self.http
+
+    def set_token(self, token):
+        # Sent with every request while the kiosk is unlocked; the server checks it against each view's permission
+        self.token = token
+
+    def request(self, method, path, timeout=REQUEST_TIMEOUT, headers=None, **kwargs):
+        # Blocking; only call from worker or background threads
+        if not self.ready.wait(timeout=timeout[0] + 5):
+            raise ConnectionError('Server not discovered yet')
+        if self.token:
+            headers = {'Authorization': f'Bearer {self.token}', **(headers or {})}
+        return self.session.request(method, f'{self.base_url}{path}', timeout=timeout, headers=headers, **kwargs)
+
+    def decode(self, response):
+        if response.headers.get('Content-Type', '').startswith(MSGPACK_MIMETYPE):
+            self.msgpack_ok = True
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
+    def post_packed(self, path, payload, **kwargs):
+        # Bodies go out as msgpack only once the server has shown it speaks it; older servers get JSON
+        if self.msgpack_ok:
+            return self.request('POST', path, data=msgpack.packb(payload, use_bin_type=True), headers={'Content-Type': MSGPACK_MIMETYPE}, **kwargs)
+        return self.request('POST', path, json=payload, **kwargs)
+
+    def submit(self, fn, on_success=None, on_error=None):
+        future = self.executor.submit(fn)
+        future.add_done_callback(lambda f: self.results.put((f, on_success, on_error)))
+
+    def deliver_results(self):
+        try:
+            while True:
+                future, on_success, on_error = self.results.get_nowait()
+                try:
+                    error = future.exception()
+                    if error is None:
+                        if on_success:
+                            on_success(future.result())
+                    elif on_error:
+                        on_error(error)
+                    else:
+                        logger.error(f"Background request failed: {error}")
+                except Exception as e:
+                    logger.error(f"Error handling server result: {e}")
+        except queue.Empty:
+            pass
+        self.root.after(RESULT_POLL_MS, self.deliver_results)
+
 class POSKiosk:
     def __init__(self, root):
         self.root = root
@@ -18,31 +224,87 @@ class POSKiosk:
         self.root.attributes('-fullscreen', True)
         self.mode = 'kiosk_staff'  # default mode
         self.locked = True
-        self.server_url = None
+        self.client = ServerClient(root)
         self.items = []
-        self.cart = []
+        self.items_by_id = {}
+        self.catalog_index = CatalogIndex([])
+        self.categories = []
+        self.shown_items = []
+        self.page = 0
+        self.catalog_etag = None
+        self.cart = {}  # item id -> quantity
+        self.cart_rows = []  # item ids in cart listbox order
+        self.cart_total = 0
         self.current_user = None
         self.rfid_sim = ''  # simulate RFID
-        self.kiosk_id = None
+        self.kiosk_id = KIOSK_ID
+        self.session_token = None
+        self.order_pending = False
         self.error_mode_active = False
-        self.discover_server()
+        self.journal = SaleJournal(JOURNAL_FILE)
+        self.sync_wakeup = threading.Event()
         self.setup_ui()
+        # The first frame comes from cached state; discovery and the network start once it has painted
+        self.root.after_idle(self.start_background)
+
+    def start_background(self):
+        logger.info(f"First frame after {(time.perf_counter() - STARTED) * 1000:.0f} ms")
+        if STARTUP_PROBE:
+            print(json.dumps({'first_frame_ms': round((time.perf_counter() - STARTED) * 1000, 1)}))
+            self.root.destroy()
+            return
+        self.client.submit(self.discover_server)
+        self.load_items()
+        self.root.after(CATALOG_REFRESH_MS, self.refresh_catalog)
+        self.sync_wakeup.set()
+        threading.Thread(target=self.sync_loop, daemon=True).start()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
 
     def discover_server(self):
+        # Runs on the I/O worker; requests wait on client.ready until this resolves.
+        # A normal boot reuses the last known server and never broadcasts.
+        cached = read_json_file(SERVER_CACHE_FILE, {})
+        server_url = cached.get('url') if cached.get('url') and self.probe_server(cached['url']) else None
+        if server_url:
+            logger.info(f"Using cached server {server_url}")
+        else:
+            server_url = self.broadcast_discovery()
+            if server_url:
+                write_json_file(SERVER_CACHE_FILE, {'url': server_url})
+            else:
+                server_url = 'http://localhost:5000'  # fallback
+        self.client.set_base_url(server_url)
+
+    def probe_server(self, url):
+        import requests
+        try:
+            return self.client.session.get(f'{url}/api/discover', timeout=(1, 2)).ok
+        except requests.RequestException:
+            return False
+
+    def broadcast_discovery(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            # Broadcast to find server
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Broadcast to find server; jitter and retries spread out a lab full of kiosks booting together
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.settimeout(5)
-            sock.sendto(b"DISCOVER_POS_SERVER", ("<broadcast>", 5001))
-            data, addr = sock.recvfrom(1024)
-            if data == b"POS_SERVER_HERE":
-                self.server_url = f"http://{addr[0]}:5000"
-                logger.info(f"Server discovered at {self.server_url}")
-            sock.close()
+            time.sleep(random.uniform(0, DISCOVERY_JITTER))
+            for timeout in DISCOVERY_TIMEOUTS:
+                sock.settimeout(timeout)
+                sock.sendto(b"DISCOVER_POS_SERVER v2", ("<broadcast>", 5001))
+                try:
+                    data, addr = sock.recvfrom(1024)
+                except socket.timeout:
+                    continue
+                if data.startswith(b"POS_SERVER_HERE"):
+                    info = json.loads(data[len(b"POS_SERVER_HERE"):] or b'{}')
+                    server_url = f"http://{addr[0]}:{info.get('port', 5000)}"
+                    logger.info(f"Server {info.get('server_id', '')} discovered at {server_url}")
+                    return server_url
         except Exception as e:
             logger.error(f"Server discovery failed: {e}")
-            self.server_url = 'http://localhost:5000'  # fallback
+        finally:
+            sock.close()
+        return None
 
     def setup_ui(self):
         # Touch-friendly: larger fonts, buttons, padding, colors
@@ -65,161 +327,497 @@ class POSKiosk:
         # Main screen
         lock_btn = tk.Button(self.main_screen, text="Lock", command=self.lock, font=('Arial', 20), height=2, width=15, bg='white')
         lock_btn.pack(pady=10)
+        self.balance_label = tk.Label(self.main_screen, text="", font=('Arial', 20), bg='lightgreen')
+        self.balance_label.pack()
         tk.Label(self.main_screen, text="Items", font=('Arial', 24), bg='lightgreen').pack()
-        self.item_list = tk.Listbox(self.main_screen, font=('Arial', 20), height=10, bg='white')
-        self.item_list.pack(fill=tk.X, padx=20, pady=10)
-        add_btn = tk.Button(self.main_screen, text="Add to Cart", command=self.add_to_cart, font=('Arial', 24), height=2, width=20, bg='white')
-        add_btn.pack(pady=10)
+        # Type to filter; a barcode scanner types the SKU followed by Enter, which adds the item straight to the cart
+        self.search_var = tk.StringVar()
+        search_entry = tk.Entry(self.main_screen, textvariable=self.search_var, font=('Arial', 20), bg='white')
+        search_entry.pack(fill=tk.X, padx=20)
+        self.search_var.trace_add('write', lambda *_: self.filter_items(reset_page=True))
+        search_entry.bind('<Return>', lambda _: self.scan_to_cart())
+        self.category_var = tk.StringVar(value=ALL_CATEGORIES)
+        self.category_bar = tk.Frame(self.main_screen, bg='lightgreen')
+        self.category_bar.pack(fill=tk.X, padx=20, pady=5)
+        # A fixed pool of cells relabelled per page, so the widget count doesn't grow with the catalog; tap a cell to add it
+        grid = tk.Frame(self.main_screen, bg='lightgreen')
+        grid.pack(fill=tk.X, padx=20, pady=5)
+        self.grid_cells = []
+        for position in range(GRID_ROWS * GRID_COLUMNS):
+            cell = tk.Button(grid, font=('Arial', 18), height=3, width=14, bg='white', command=lambda position=position: self.on_cell(position))
+            cell.grid(row=position // GRID_COLUMNS, column=position % GRID_COLUMNS, padx=4, pady=4, sticky='nsew')
+            self.grid_cells.append(cell)
+        self.cell_contents = [()] * len(self.grid_cells)
+        pager = tk.Frame(self.main_screen, bg='lightgreen')
+        pager.pack()
+        tk.Button(pager, text="< Prev", command=lambda: self.turn_page(-1), font=('Arial', 20), width=8, bg='white').pack(side=tk.LEFT, padx=10)
+        self.page_label = tk.Label(pager, text="", font=('Arial', 20), width=20, bg='lightgreen')
+        self.page_label.pack(side=tk.LEFT)
+        tk.Button(pager, text="Next >", command=lambda: self.turn_page(1), font=('Arial', 20), width=8, bg='white').pack(side=tk.LEFT, padx=10)
         tk.Label(self.main_screen, text="Cart", font=('Arial', 24), bg='lightgreen').pack()
         self.cart_list = tk.Listbox(self.main_screen, font=('Arial', 20), height=5, bg='white')
-        self.cart_list.pack(fill=tk.X, padx=20, pady=10)
+        self.cart_list.pack(fill=tk.X, padx=20, pady=5)
+        self.total_label = tk.Label(self.main_screen, text="Total: $0.00", font=('Arial', 24), bg='lightgreen')
+        self.total_label.pack()
+        remove_btn = tk.Button(self.main_screen, text="Remove One", command=self.remove_from_cart, font=('Arial', 20), height=1, width=20, bg='white')
+        remove_btn.pack(pady=5)
         checkout_btn = tk.Button(self.main_screen, text="Checkout", command=self.checkout, font=('Arial', 24), height=2, width=20, bg='white')
         checkout_btn.pack(pady=10)
-        if self.mode in ['teacher', 'admin']:
-            manual_btn = tk.Button(self.main_screen, text="Manual Charge", command=self.manual_charge, font=('Arial', 24), height=2, width=20, bg='white')
-            manual_btn.pack(pady=10)
-        if self.mode == 'admin':
-            manage_btn = tk.Button(self.main_screen, text="Manage Items", command=self.manage_items, font=('Arial', 24), height=2, width=20, bg='white')
-            manage_btn.pack(pady=10)
-            custom_btn = tk.Button(self.main_screen, text="Custom Charge", command=self.custom_charge, font=('Arial', 24), height=2, width=20, bg='white')
-            custom_btn.pack(pady=10)
+        manual_btn = tk.Button(self.main_screen, text="Manual Charge", command=self.manual_charge, font=('Arial', 24), height=2, width=20, bg='white')
+        manage_btn = tk.Button(self.main_screen, text="Manage Items", command=self.manage_items, font=('Arial', 24), height=2, width=20, bg='white')
+        custom_btn = tk.Button(self.main_screen, text="Custom Charge", command=self.custom_charge, font=('Arial', 24), height=2, width=20, bg='white')
+        self.permission_buttons = [(manual_btn, 'sale.manual'), (manage_btn, 'item.manage'), (custom_btn, 'sale.manual')]
 
         # Error screen
         tk.Label(self.error_screen, text="Error Mode: Cannot connect to server", font=('Arial', 24), bg='red').pack(pady=20)
         retry_btn = tk.Button(self.error_screen, text="Retry", command=self.retry_connection, font=('Arial', 24), height=2, width=20, bg='white')
         retry_btn.pack()
 
-        self.load_items()
+        self.show_cached_items()
+
+    def on_server_error(self, error):
+        logger.error(f"Server request failed: {error}")
+        self.enter_error_mode()
 
     def unlock_password(self):
         try:
             password = simpledialog.askstring("Password", "Enter password:")
             if password:
-                if self.mode_var.get() == 'kiosk_staff' and self.check_password('kiosk', password):
-                    self.unlock('kiosk_staff')
-                elif self.mode_var.get() == 'teacher' and self.check_password('teacher', password):
-                    self.unlock('teacher')
-                elif self.mode_var.get() == 'admin' and self.check_password('admin', password):
-                    self.unlock('admin')
+                mode = self.mode_var.get()
+
+                def on_checked(auth):
+                    if auth:
+                        self.session_token = auth['token']
+                        self.client.set_token(self.session_token)
+                        self.unlock(mode, auth.get('permissions', []))
+                    else:
+                        messagebox.showerror("Error", "Incorrect password")
+                self.client.submit(lambda: self.check_password(mode, password), on_checked, self.on_server_error)
         except Exception as e:
             logger.error(f"Error unlocking with password: {e}")
             self.enter_error_mode()
 
     def check_password(self, mode, password):
-        try:
-            response = requests.get(f'{self.server_url}/api/kiosks')
-            kiosks = response.json()
-            for kiosk in kiosks:
-                if kiosk['id'] == self.kiosk_id:
-                    if mode == 'kiosk' and check_password_hash(kiosk['password_kiosk'], password):
-                        return True
-                    elif mode == 'teacher' and check_password_hash(kiosk['password_teacher'], password):
-                        return True
-                    elif mode == 'admin' and check_password_hash(kiosk['password_admin'], password):
-                        return True
-        except Exception as e:
-            logger.error(f"Error checking password: {e}")
-            self.enter_error_mode()
-        return False
+        # Runs on the I/O worker; the server verifies and returns a session token, or None if rejected
+        response = self.client.request('POST', f'/api/kiosk/{self.kiosk_id}/auth', json={'mode': mode, 'password': password})
+        if response.status_code == 401:
+            return None
+        response.raise_for_status()
+        return response.json()
 
     def scan_rfid(self):
+        # The reader blocks until a card is presented, so it runs on the I/O worker too
+        self.client.submit(self.read_rfid_tag, self.on_rfid_read, self.on_rfid_reader_failed)
+
+    def read_rfid_tag(self):
+        # Try hardware RFID reader first. nfcpy loads on the first tap rather than at startup;
+        # if it isn't installed the ImportError falls back to simulation like any reader failure.
+        import nfc
+        clf = nfc.ContactlessFrontend('usb')
         try:
-            # Try hardware RFID reader first
-            clf = nfc.ContactlessFrontend('usb')
             tag = clf.connect(rdwr={'on-connect': lambda tag: False})
-            if tag:
-                self.rfid_sim = str(tag.identifier).upper()
-                self.unlock_with_rfid()
+            return str(tag.identifier).upper() if tag else None
+        finally:
             clf.close()
-        except Exception as e:
-            logger.warning(f"Hardware RFID failed: {e}, falling back to simulation")
-            # Fallback to simulation
-            rfid = simpledialog.askstring("RFID", "Enter RFID:")
-            if rfid:
-                self.rfid_sim = rfid
-                self.unlock_with_rfid()
+
+    def on_rfid_reader_failed(self, error):
+        logger.warning(f"Hardware RFID failed: {error}, falling back to simulation")
+        # Fallback to simulation
+        self.on_rfid_read(simpledialog.askstring("RFID", "Enter RFID:"))
+
+    def on_rfid_read(self, rfid):
+        if rfid:
+            self.rfid_sim = rfid
+            self.unlock_with_rfid()
 
     def unlock_with_rfid(self):
-        try:
-            response = requests.get(f'{self.server_url}/api/users')
-            users = response.json()
-            for user in users:
-                if user['rfid'] == self.rfid_sim:
-                    self.unlock(user['privilege'])
-                    self.current_user = user
-                    break
-        except Exception as e:
-            logger.error(f"Error unlocking with RFID: {e}")
-            self.enter_error_mode()
+        rfid = self.rfid_sim
+        self.client.submit(lambda: self.fetch_rfid_user(rfid), self.on_rfid_user, self.on_server_error)
+
+    def fetch_rfid_user(self, rfid):
+        response = self.client.request('GET', f'/api/users/by-rfid/{quote(rfid, safe="")}')
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        user = response.json()
+        auth = self.client.request('POST', f'/api/kiosk/{self.kiosk_id}/auth', json={'rfid': rfid})
+        auth.raise_for_status()
+        user['auth'] = auth.json()
+        return user
+
+    def on_rfid_user(self, user):
+        if not user:
+            messagebox.showerror("Error", "Unknown RFID card")
+            return
+        auth = user.pop('auth')
+        self.session_token = auth['token']
+        self.client.set_token(self.session_token)
+        self.unlock(user['privilege'], auth.get('permissions', []))
+        self.current_user = user
+        self.show_balance()
+
+    def show_balance(self):
+        user = self.current_user
+        if not user or 'balance' not in user:
+            self.balance_label.config(text="")
+            return
+        text = f"{user['username']}: balance ${user['balance']:.2f}"
+        if user.get('available') is not None:
+            text += f" (${user['available']:.2f} available)"
+        self.balance_label.config(text=text)
+
+    def refresh_balance(self):
+        user = self.current_user
+        if not user:
+            return
+
+        def fetch_balance():
+            response = self.client.request('GET', f"/api/users/{user['id']}/balance")
+            response.raise_for_status()
+            return response.json()
+
+        def on_balance(account):
+            if self.current_user is user:
+                user.update(balance=account['balance'], available=account['available'])
+                self.show_balance()
+        self.client.submit(fetch_balance, on_balance, lambda e: logger.warning(f"Error refreshing balance: {e}"))
+
+    def spend_balance(self, amount):
+        # Tracks the balance locally until the next tap or refused sale
+        user = self.current_user
+        if user and 'balance' in user:
+            user['balance'] = round(user['balance'] - amount, 2)
+            if user.get('available') is not None:
+                user['available'] = round(user['available'] - amount, 2)
+            self.show_balance()
 
-    def unlock(self, mode):
+    def unlock(self, mode, permissions=()):
         self.mode = mode
         self.locked = False
+        # Buttons follow the permissions the server granted this session rather than the mode name
+        for button, _ in self.permission_buttons:
+            button.pack_forget()
+        for button, permission in self.permission_buttons:
+            if permission in permissions:
+                button.pack(pady=10)
         self.lock_screen.pack_forget()
         self.main_screen.pack(fill=tk.BOTH, expand=True)
 
     def lock(self):
         self.locked = True
+        self.session_token = None
+        self.client.set_token(None)
         self.main_screen.pack_forget()
         self.lock_screen.pack(fill=tk.BOTH, expand=True)
 
+    def show_cached_items(self):
+        cached = read_json_file(CATALOG_CACHE_FILE, {})
+        if cached.get('items'):
+            self.catalog_etag = cached.get('etag')
+            self.show_items(cached['items'])
+
+    def refresh_catalog(self):
+        self.load_items()
+        self.root.after(CATALOG_REFRESH_MS, self.refresh_catalog)
+
     def load_items(self):
-        try:
-            response = requests.get(f'{self.server_url}/api/items')
-            self.items = response.json()
-            self.item_list.delete(0, tk.END)
-            for item in self.items:
-                self.item_list.insert(tk.END, f"{item['name']} - ${item['price']}")
-        except Exception as e:
-            logger.error(f"Error loading items: {e}")
+        # Paint from the local cache right away, then revalidate against the server in the background
+        if not self.items:
+            self.show_cached_items()
+        etag = self.catalog_etag if self.items else None
+        self.client.submit(lambda: self.fetch_items(etag), self.on_items_fetched, self.on_items_failed)
+
+    def fetch_items(self, etag):
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self.client.request('GET', '/api/items', headers=headers)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        catalog = {'etag': response.headers.get('ETag'), 'items': decode_table(self.client.decode(response))}
+        write_json_file(CATALOG_CACHE_FILE, catalog)
+        return catalog
+
+    def on_items_fetched(self, catalog):
+        if catalog:
+            self.catalog_etag = catalog['etag']
+            self.show_items(catalog['items'])
+
+    def on_items_failed(self, error):
+        logger.error(f"Error loading items: {error}")
+        if not self.items:
             self.enter_error_mode()
 
-    def add_to_cart(self):
+    def show_items(self, items):
+        # Applied as a diff: an unchanged catalog touches nothing, and only grid cells and cart rows whose item changed are redrawn
+        by_id = {item['id']: item for item in items}
+        changed = {item_id for item_id in by_id.keys() | self.items_by_id.keys() if by_id.get(item_id) != self.items_by_id.get(item_id)}
+        if not changed and self.items:
+            return
+        self.items_by_id = by_id
+        # Sorted by category so the "All" view pages through one group after another
+        self.items = sorted(items, key=lambda item: ((item.get('category') or OTHER_CATEGORY).lower(), item['name'].lower()))
+        self.catalog_index = CatalogIndex(self.items)
+        categories = sorted({item.get('category') or OTHER_CATEGORY for item in items}, key=str.lower)
+        if categories != self.categories:
+            self.show_categories(categories)
+        for item_id in changed & self.cart.keys():
+            self.show_cart_row(item_id)
+        self.cart_total = round(sum(self.items_by_id[item_id]['price'] * quantity for item_id, quantity in self.cart.items()), 2)
+        self.show_total()
+        self.filter_items()
+
+    def show_categories(self, categories):
+        self.categories = categories
+        for button in self.category_bar.winfo_children():
+            button.destroy()
+        if self.category_var.get() not in categories:
+            self.category_var.set(ALL_CATEGORIES)
+        for category in [ALL_CATEGORIES] + categories:
+            tk.Radiobutton(self.category_bar, text=category, value=category, variable=self.category_var, indicatoron=False,
+                           command=lambda: self.filter_items(reset_page=True), font=('Arial', 18), padx=10, pady=5, bg='white').pack(side=tk.LEFT, padx=2)
+
+    def filter_items(self, reset_page=False):
+        matches = self.catalog_index.search(self.search_var.get())
+        category = self.category_var.get()
+        if category != ALL_CATEGORIES:
+            matches = [item for item in matches if (item.get('category') or OTHER_CATEGORY) == category]
+        self.shown_items = matches
+        if reset_page:
+            self.page = 0
+        self.show_page()
+
+    def show_page(self):
+        page_size = len(self.grid_cells)
+        pages = max(1, -(-len(self.shown_items) // page_size))
+        self.page = max(0, min(self.page, pages - 1))
+        start = self.page * page_size
+        for position, cell in enumerate(self.grid_cells):
+            item = self.shown_items[start + position] if start + position < len(self.shown_items) else None
+            contents = (item['name'], item['price'], item.get('sold_out')) if item else None
+            if contents == self.cell_contents[position]:
+                continue
+            self.cell_contents[position] = contents
+            if item is None:
+                cell.config(text='', state=tk.DISABLED)
+            else:
+                cell.config(text=f"{item['name']}\n${item['price']:.2f}" + ("\nSold out" if item.get('sold_out') else ""),
+                            state=tk.DISABLED if item.get('sold_out') else tk.NORMAL)
+        category = (self.shown_items[start].get('category') or OTHER_CATEGORY) if self.shown_items else ''
+        self.page_label.config(text=f"{category}  {self.page + 1} / {pages}")
+
+    def turn_page(self, step):
+        self.page += step
+        self.show_page()
+
+    def on_cell(self, position):
+        index = self.page * len(self.grid_cells) + position
+        if index < len(self.shown_items):
+            self.put_in_cart(self.shown_items[index])
+
+    def scan_to_cart(self):
+        code = self.search_var.get().strip()
+        item = self.catalog_index.by_sku.get(code)
+        if item is None and len(self.shown_items) == 1:
+            item = self.shown_items[0]
+        if item is None:
+            return
+        self.put_in_cart(item)
+        self.search_var.set('')
+
+    def put_in_cart(self, item):
         try:
-            selection = self.item_list.curselection()
-            if selection:
-                item = self.items[selection[0]]
-                self.cart.append(item)
-                self.cart_list.insert(tk.END, f"{item['name']} - ${item['price']}")
+            if item.get('sold_out'):
+                messagebox.showerror("Error", f"{item['name']} is sold out")
+                return
+            self.cart[item['id']] = self.cart.get(item['id'], 0) + 1
+            self.cart_total = round(self.cart_total + item['price'], 2)
+            self.show_cart_row(item['id'])
+            self.show_total()
         except Exception as e:
             logger.error(f"Error adding to cart: {e}")
             self.enter_error_mode()
 
+    def remove_from_cart(self):
+        selection = self.cart_list.curselection()
+        if not selection:
+            return
+        item_id = self.cart_rows[selection[0]]
+        self.cart[item_id] -= 1
+        self.cart_total = round(self.cart_total - self.items_by_id[item_id]['price'], 2)
+        if not self.cart[item_id]:
+            del self.cart[item_id]
+        self.show_cart_row(item_id)
+        self.show_total()
+
+    def show_cart_row(self, item_id):
+        # Rewrites just this item's row; items dropped from the catalog leave the cart
+        item = self.items_by_id.get(item_id)
+        if item is None:
+            self.cart.pop(item_id, None)
+        row = self.cart_rows.index(item_id) if item_id in self.cart_rows else None
+        if row is not None:
+            self.cart_list.delete(row)
+        if item_id not in self.cart:
+            if row is not None:
+                self.cart_rows.pop(row)
+            return
+        quantity = self.cart[item_id]
+        text = f"{item['name']} x{quantity} - ${item['price'] * quantity:.2f}"
+        if row is None:
+            self.cart_rows.append(item_id)
+            self.cart_list.insert(tk.END, text)
+        else:
+            self.cart_list.insert(row, text)
+
+    def show_total(self):
+        self.total_label.config(text=f"Total: ${self.cart_total:.2f}")
+
+    def clear_cart(self):
+        self.cart = {}
+        self.cart_rows = []
+        self.cart_total = 0
+        self.cart_list.delete(0, tk.END)
+        self.show_total()
+
     def checkout(self):
         try:
             if not self.current_user:
                 messagebox.showerror("Error", "No user selected")
                 return
-            total = sum(item['price'] for item in self.cart)
-            for item in self.cart:
-                requests.post(f'{self.server_url}/api/sales', json={
-                    'user_id': self.current_user['id'],
-                    'item_id': item['id'],
-                    'quantity': 1,
-                    'total_price': item['price']
-                })
-            self.cart = []
-            self.cart_list.delete(0, tk.END)
-            messagebox.showinfo("Success", f"Checkout complete. Total: ${total}")
+            if not self.cart or self.order_pending:
+                return
+            total = self.cart_total
+            available = self.current_user.get('available')
+            if available is not None and total > available:
+                messagebox.showerror("Error", f"Insufficient funds: ${available:.2f} available")
+                return
+            self.order_pending = True
+            self.submit_order({
+                'user_id': self.current_user['id'],
+                'kiosk_id': self.kiosk_id,
+                'items': [{'item_id': item_id, 'quantity': quantity} for item_id, quantity in self.cart.items()]
+            }, lambda error: self.on_checkout_done(total, error))
         except Exception as e:
+            self.order_pending = False
             logger.error(f"Error during checkout: {e}")
             self.enter_error_mode()
 
+    def on_checkout_done(self, total, error):
+        self.order_pending = False
+        if error:
+            messagebox.showerror("Sale rejected", error)
+            # Usually something sold out since the grid was drawn, or the balance moved since the tap
+            self.load_items()
+            self.refresh_balance()
+            return
+        self.clear_cart()
+        self.spend_balance(total)
+        messagebox.showinfo("Success", f"Checkout complete. Total: ${total}")
+
     def manual_charge(self):
         try:
             user_id = simpledialog.askinteger("User ID", "Enter user ID:")
             amount = simpledialog.askfloat("Amount", "Enter amount:")
             if user_id and amount:
-                requests.post(f'{self.server_url}/api/sales', json={
+                self.submit_order({
                     'user_id': user_id,
-                    'item_id': 0,  # dummy
-                    'quantity': 1,
-                    'total_price': amount
-                })
+                    'kiosk_id': self.kiosk_id,
+                    'items': [{'item_id': 0, 'amount': amount}]
+                }, self.on_manual_charge_done)
         except Exception as e:
             logger.error(f"Error in manual charge: {e}")
             self.enter_error_mode()
 
+    def on_manual_charge_done(self, error):
+        if error:
+            messagebox.showerror("Charge rejected", error)
+
+    def submit_order(self, order, on_done):
+        # Online, the order is booked live so the server can refuse a sell-out or a credit limit while the
+        # customer is still at the till; on_done gets None or the reason. Only when the server can't be reached
+        # is it journaled and marked offline; any error response is a failed sale. The key is fixed up front,
+        # so a live attempt that timed out after booking is a duplicate when the journal replays it.
+        order['idempotency_key'] = uuid.uuid4().hex
+        order['timestamp'] = datetime.utcnow().isoformat()
+        token = self.session_token
+
+        def on_failed(error):
+            if isinstance(error, ServerUnreachable):
+                self.journal_offline(order, token, error, on_done)
+            else:
+                logger.error(f"Error submitting sale {order['idempotency_key']}: {error}")
+                on_done(f'Sale failed: {error}')
+        self.client.submit(lambda: self.post_order(order), on_done, on_failed)
+
+    def post_order(self, order):
+        import requests  # for its exception types; loads here on the I/O worker, like the client session
+        try:
+            response = self.client.request('POST', '/api/orders', json=order)
+        except (ConnectionError, requests.ConnectionError, requests.Timeout) as e:
+            raise ServerUnreachable(e)
+        if response.ok:
+            return None
+        try:
+            error = response.json().get('error')
+        except ValueError:
+            error = None
+        return error or f'Server error {response.status_code}'
+
+    def journal_offline(self, order, token, error, on_done):
+        logger.warning(f"Server unreachable, journaling sale {order['idempotency_key']}: {error}")
+        # The entry keeps the session it was rung up under, so it syncs with that operator's permissions
+        order['operator_token'] = token
+        order['offline'] = True
+        self.journal.append(order)
+        self.sync_wakeup.set()
+        on_done(None)
+
+    def sync_loop(self):
+        backoff = 1
+        while True:
+            self.sync_wakeup.wait(timeout=backoff if backoff > 1 else 30)
+            self.sync_wakeup.clear()
+            try:
+                while self.sync_batch():
+                    pass
+                backoff = 1
+            except Exception as e:
+                backoff = min(backoff * 2, SYNC_MAX_BACKOFF)
+                logger.warning(f"Sale sync failed, {self.journal.depth()} queued, retrying in {backoff}s: {e}")
+
+    def sync_batch(self):
+        orders = self.journal.pending(SYNC_BATCH_SIZE)
+        if not orders:
+            return False
+        response = self.client.post_packed('/api/orders/batch', {'orders': orders}, timeout=(3, 15))
+        response.raise_for_status()
+        delivered = []
+        for result in decode_table(self.client.decode(response)['results']):
+            if result['status'] == 'rejected':
+                logger.error(f"Server rejected queued sale {result['idempotency_key']}: {result.get('error')}")
+                self.journal.reject(result['idempotency_key'], result.get('error') or 'rejected')
+            else:
+                delivered.append(result['idempotency_key'])
+        self.journal.acknowledge(delivered)
+        return len(orders) == SYNC_BATCH_SIZE
+
+    def heartbeat_loop(self):
+        # Each beat reports the round trip of the previous one, so the server sees real kiosk-side latency
+        latency_ms = None
+        while True:
+            try:
+                started = time.monotonic()
+                self.client.request('POST', f'/api/kiosk/{self.kiosk_id}/heartbeat', json={
+                    'latency_ms': latency_ms,
+                    'queue_depth': self.journal.depth(),
+                    'error_mode': self.error_mode_active
+                }, timeout=(3, 5))
+                latency_ms = round((time.monotonic() - started) * 1000, 1)
+            except Exception as e:
+                latency_ms = None
+                logger.debug(f"Heartbeat failed: {e}")
+            time.sleep(HEARTBEAT_INTERVAL)
+
     def custom_charge(self):
         try:
             amount = simpledialog.askfloat("Amount", "Enter custom amount:")
@@ -235,9 +833,11 @@ class POSKiosk:
             # Simple add item
             name = simpledialog.askstring("Item Name", "Enter item name:")
             price = simpledialog.askfloat("Price", "Enter price:")
+            category = simpledialog.askstring("Category", "Enter category (optional):")
             if name and price:
-                requests.post(f'{self.server_url}/api/items', json={'name': name, 'price': price})
-                self.load_items()
+                def add_item():
+                    self.client.request('POST', '/api/items', json={'name': name, 'price': price, 'category': category or None}).raise_for_status()
+                self.client.submit(add_item, lambda _: self.load_items(), self.on_server_error)
         except Exception as e:
             logger.error(f"Error managing items: {e}")
             self.enter_error_mode()
@@ -253,7 +853,8 @@ class POSKiosk:
         self.error_mode_active = False
         self.error_screen.pack_forget()
         self.lock_screen.pack(fill=tk.BOTH, expand=True)
-        self.discover_server()
+        self.client.reset()
+        self.client.submit(self.discover_server)
         self.load_items()
 
 if __name__ == '__main__':
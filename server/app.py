@@ -1,26 +1,76 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, stream_with_context, has_request_context, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text, event, bindparam
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
 from werkzeug.security import generate_password_hash, check_password_hash
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 import os
-from datetime import datetime
+import time
+import hmac
+import hashlib
+import json
+from datetime import datetime, date, timedelta
 import socket
 import logging
+import threading
+import sqlite3
+import queue
+import bisect
+import heapq
+import functools
+import gzip
+import csv
+import io
+from collections import deque, defaultdict, OrderedDict
+from discovery_server import discovery_server, default_server_id
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///instance/pos.db'
-app.config['SQLALCHEMY_BINDS'] = {
-    'users': 'sqlite:///instance/users.db',
-    'items': 'sqlite:///instance/items.db',
-    'permissions': 'sqlite:///instance/permissions.db'
-}
-db = SQLAlchemy(app)
+os.makedirs(app.instance_path, exist_ok=True)
+# One database for everything so foreign keys are real and reports can join; see migrate_db.py for merging old split files
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('POS_DATABASE_URL', 'sqlite:///' + os.path.join(app.instance_path, 'pos.db'))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+database_url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+if database_url.database not in (None, '', ':memory:') and database_url.query.get('mode') != 'memory':
+    # In-memory SQLite gets a StaticPool, which takes no QueuePool sizing
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=int(os.environ.get('POS_DB_POOL_SIZE', 10)), max_overflow=10, pool_timeout=30)
+LEGACY_DATABASES = ('users.db', 'items.db', 'permissions.db')
+# Objects stay readable after commit; views serialize what they just wrote without a reload query
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets dashboard reads proceed during kiosk checkouts; NORMAL syncs only at checkpoints in WAL mode
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.execute('PRAGMA busy_timeout=30000')
+        cursor.close()
+        # Let SQLAlchemy emit BEGIN itself (see begin_sqlite_transaction) instead of pysqlite's implicit one
+        dbapi_connection.isolation_level = None
+
+@event.listens_for(Engine, 'begin')
+def begin_sqlite_transaction(conn):
+    # With several worker processes, a deferred transaction that reads and then writes can fail with
+    # SQLITE_BUSY immediately if another process committed in between, without waiting busy_timeout.
+    # Write requests therefore take the write lock up front and queue behind each other instead.
+    if conn.dialect.name == 'sqlite':
+        write = has_request_context() and request.method not in ('GET', 'HEAD', 'OPTIONS')
+        conn.exec_driver_sql('BEGIN IMMEDIATE' if write else 'BEGIN')
+
 class User(db.Model):
-    __bind_key__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(120), nullable=False)
@@ -28,25 +78,104 @@ class User(db.Model):
     rfid = db.Column(db.String(50), unique=True, nullable=True)
 
 class Item(db.Model):
-    __bind_key__ = 'items'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Float, nullable=False)
+    sku = db.Column(db.String(64), unique=True, index=True, nullable=True)  # barcode or stock code
+    category = db.Column(db.String(50), nullable=True)
+    stock = db.Column(db.Integer, nullable=True)  # units on hand; NULL when stock isn't tracked
+    low_stock_threshold = db.Column(db.Integer, nullable=True)
+
+class StockMovement(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False, index=True)
+    change = db.Column(db.Integer, nullable=False)
+    stock_after = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)  # sale, restock, adjustment, count
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=True)
+    note = db.Column(db.String(200), nullable=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Permission(db.Model):
-    __bind_key__ = 'permissions'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, nullable=False)
-    permission = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    permission = db.Column(db.String(50), nullable=False)  # a grant on top of the user's privilege, or '-name' to revoke one
 
-class Sale(db.Model):
+class Version(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class Order(db.Model):
+    __tablename__ = 'orders'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=False)
+    kiosk_id = db.Column(db.Integer, nullable=True)
+    total_price = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    idempotency_key = db.Column(db.String(64), unique=True, index=True, nullable=True)
+
+class Sale(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=True, index=True)  # NULL for manual charges
+    kiosk_id = db.Column(db.Integer, nullable=True, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     total_price = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class SalePartition(db.Model):
+    # Manifest of archived months: each row is one SQLite file in the archive directory holding that month's sales
+    name = db.Column(db.String(7), primary_key=True)  # YYYY-MM
+    since = db.Column(db.DateTime, nullable=False)
+    until = db.Column(db.DateTime, nullable=False)
+    path = db.Column(db.String(255), nullable=False)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+    total_price = db.Column(db.Float, nullable=False, default=0)
+    min_id = db.Column(db.Integer, nullable=True)
+    max_id = db.Column(db.Integer, nullable=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Account(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    balance = db.Column(db.Float, nullable=False, default=0)  # running total of the user's ledger entries
+    credit_limit = db.Column(db.Float, nullable=True)  # how far below zero the balance may go; NULL for no limit
+
+class LedgerEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # deposit, charge, refund, adjustment
+    amount = db.Column(db.Float, nullable=False)  # signed: charges are negative
+    balance_after = db.Column(db.Float, nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=True, index=True)
+    note = db.Column(db.String(200), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+# Rollups maintained on every Sale insert (see update_rollups); key 0 stands for "none" (manual charge / unknown kiosk)
+class ItemDailySales(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    item_id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    total_price = db.Column(db.Float, nullable=False, default=0)
+
+class UserDailySales(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    total_price = db.Column(db.Float, nullable=False, default=0)
+
+class KioskHourlySales(db.Model):
+    hour = db.Column(db.DateTime, primary_key=True)
+    kiosk_id = db.Column(db.Integer, primary_key=True)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+    total_price = db.Column(db.Float, nullable=False, default=0)
+
+class ChangeEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # sale, item, user, kiosk, import, stock
+    payload = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 class Kiosk(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -55,6 +184,1319 @@ class Kiosk(db.Model):
     password_admin = db.Column(db.String(120), nullable=False)
     status = db.Column(db.String(20), default='normal')  # normal, maintenance, error
     ip_address = db.Column(db.String(50), nullable=True)
+    last_seen = db.Column(db.DateTime, nullable=True)  # flushed from kiosk_health in batches
+
+def warn_legacy_databases():
+    legacy = [name for name in LEGACY_DATABASES if os.path.exists(os.path.join(app.instance_path, name))]
+    if legacy:
+        logger.warning(f"Found split databases {legacy} in {app.instance_path}; run 'python migrate_db.py' to merge them into pos.db")
+
+def upgrade_schema():
+    # create_all() never alters existing tables, so add columns introduced since the db was created
+    engine = db.engine
+    for table in db.metadata.sorted_tables:
+        existing = {c['name'] for c in inspect(engine).get_columns(table.name)}
+        with engine.begin() as conn:
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(engine.dialect)}'))
+                    logger.info(f"Added column {table.name}.{column.name}")
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+ITEM_SEARCH_LIMIT = 50
+item_fts = db.table('item_fts', db.column('rowid'), db.column('rank'))
+item_search_enabled = False
+
+def ensure_item_search():
+    # FTS5 index over item names and SKUs, kept in sync by triggers so every writer (including
+    # migrate_db.py and bulk imports) maintains it. Falls back to LIKE where sqlite lacks FTS5.
+    global item_search_enabled
+    with db.engine.begin() as conn:
+        try:
+            created = not conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'item_fts'")).first()
+            conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(name, sku, content='item', content_rowid='id', prefix='1 2 3')"))
+        except Exception as e:
+            logger.warning(f"SQLite FTS5 unavailable, item search falls back to LIKE: {e}")
+            return
+        conn.execute(text("""CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item BEGIN
+            INSERT INTO item_fts(rowid, name, sku) VALUES (new.id, new.name, new.sku); END"""))
+        conn.execute(text("""CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item BEGIN
+            INSERT INTO item_fts(item_fts, rowid, name, sku) VALUES ('delete', old.id, old.name, old.sku); END"""))
+        conn.execute(text("""CREATE TRIGGER IF NOT EXISTS item_fts_update AFTER UPDATE ON item BEGIN
+            INSERT INTO item_fts(item_fts, rowid, name, sku) VALUES ('delete', old.id, old.name, old.sku);
+            INSERT INTO item_fts(rowid, name, sku) VALUES (new.id, new.name, new.sku); END"""))
+        if created:
+            conn.execute(text("INSERT INTO item_fts(item_fts) VALUES ('rebuild')"))
+            logger.info("Built item search index")
+    item_search_enabled = True
+
+def search_items(q, limit=ITEM_SEARCH_LIMIT):
+    terms = q.split()
+    if not terms:
+        return []
+    if item_search_enabled:
+        # Every term is a quoted prefix, so user input can't inject FTS5 query syntax
+        match = ' '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+        return Item.query.join(item_fts, item_fts.c.rowid == Item.id) \
+            .filter(text('item_fts MATCH :match')).params(match=match) \
+            .order_by(item_fts.c.rank).limit(limit).all()
+    query = Item.query
+    for term in terms:
+        query = query.filter(db.or_(Item.name.ilike(f'%{term}%'), Item.sku.ilike(f'{term}%')))
+    return query.order_by(Item.name).limit(limit).all()
+
+ROLLUPS = (
+    (ItemDailySales, lambda s: {'day': s.timestamp.date(), 'item_id': s.item_id or 0}, lambda s: {'quantity': s.quantity, 'total_price': s.total_price}),
+    (UserDailySales, lambda s: {'day': s.timestamp.date(), 'user_id': s.user_id}, lambda s: {'quantity': s.quantity, 'total_price': s.total_price}),
+    (KioskHourlySales, lambda s: {'hour': s.timestamp.replace(minute=0, second=0, microsecond=0), 'kiosk_id': s.kiosk_id or 0}, lambda s: {'sale_count': 1, 'total_price': s.total_price}),
+)
+
+def apply_rollups(connection, sales):
+    # Aggregate in Python first so a multi-line order costs one upsert per rollup row, not per line
+    for model, key_of, values_of in ROLLUPS:
+        totals = {}
+        for sale in sales:
+            key = tuple(key_of(sale).items())
+            current = totals.setdefault(key, dict.fromkeys(values_of(sale), 0))
+            for name, value in values_of(sale).items():
+                current[name] += value
+        for key, values in totals.items():
+            stmt = sqlite_insert(model.__table__).values(**dict(key), **values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[name for name, _ in key],
+                set_={name: getattr(model.__table__.c, name) + getattr(stmt.excluded, name) for name in values})
+            connection.execute(stmt)
+
+@event.listens_for(Session, 'after_flush')
+def update_rollups(session, flush_context):
+    # Same transaction as the Sale insert, so rollups can never drift from committed sales
+    sales = [obj for obj in session.new if isinstance(obj, Sale)]
+    if sales:
+        apply_rollups(session.connection(), sales)
+
+def backfill_rollups():
+    # Builds rollups for sales recorded before they existed; only runs when every rollup table is empty
+    if any(db.session.query(model).first() for model, _, _ in ROLLUPS) or not db.session.query(Sale.id).first():
+        return
+    logger.info("Backfilling sales rollups")
+    connection = db.session.connection()
+    for sales in batched_sales(Sale.query):
+        apply_rollups(connection, sales)
+    db.session.commit()
+
+EVENT_POLL_INTERVAL = 1.0
+EVENT_RETENTION = timedelta(days=1)
+EVENT_REPLAY_LIMIT = 1000
+EVENT_KEEPALIVE = 15
+EVENT_SUBSCRIBER_BACKLOG = 1000
+EVENT_STREAM_LIMIT = int(os.environ.get('POS_EVENT_STREAMS', 4))  # open streams per process; each holds a server thread
+EVENT_STREAM_RETRY = 10  # seconds, sent as Retry-After when a process is at its limit
+
+def record_event(kind, payload):
+    # Written in the caller's transaction, so subscribers only ever see committed changes
+    db.session.add(ChangeEvent(kind=kind, payload=json.dumps(payload)))
+    db.session.info['events_pending'] = True
+
+@event.listens_for(Session, 'after_commit')
+def notify_event_broker(session):
+    if session.info.pop('events_pending', False):
+        event_broker.notify()
+
+def format_event(change):
+    return f"id: {change.id}\nevent: {change.kind}\ndata: {change.payload}\n\n"
+
+class EventBroker:
+    # One poller per process reads new ChangeEvent rows and fans them out to every open stream,
+    # so database load follows the rate of changes rather than the number of dashboards.
+    # Commits in this process wake it immediately; other workers' changes arrive on the next poll.
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.last_id = None
+        self.thread = None
+        self.limit = EVENT_STREAM_LIMIT
+
+    def subscribe(self):
+        # None when this process already serves its limit of streams, so dashboards can't take every thread
+        subscriber = queue.Queue(maxsize=EVENT_SUBSCRIBER_BACKLOG)
+        with self.lock:
+            if len(self.subscribers) >= self.limit:
+                return None
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.poll_loop, daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def notify(self):
+        self.wakeup.set()
+
+    def poll_loop(self):
+        last_prune = 0
+        while True:
+            self.wakeup.wait(EVENT_POLL_INTERVAL)
+            self.wakeup.clear()
+            try:
+                with app.app_context():
+                    self.poll_once()
+                    if time.monotonic() - last_prune > 3600:
+                        db.session.rollback()  # end the read transaction so the delete starts with the write lock
+                        ChangeEvent.query.filter(ChangeEvent.timestamp < datetime.utcnow() - EVENT_RETENTION).delete()
+                        db.session.commit()
+                        last_prune = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error polling change events: {e}")
+
+    def poll_once(self):
+        if self.last_id is None:
+            self.last_id = db.session.query(db.func.max(ChangeEvent.id)).scalar() or 0
+        changes = ChangeEvent.query.filter(ChangeEvent.id > self.last_id).order_by(ChangeEvent.id).limit(EVENT_REPLAY_LIMIT).all()
+        if not changes:
+            return
+        self.last_id = changes[-1].id
+        messages = [(c.id, format_event(c)) for c in changes]
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                for message in messages:
+                    subscriber.put_nowait(message)
+            except queue.Full:
+                # A stalled client; dropping it makes the browser reconnect and replay from Last-Event-ID
+                self.unsubscribe(subscriber)
+                subscriber.put(None)
+
+event_broker = EventBroker()
+
+HEARTBEAT_INTERVAL = 15
+KIOSK_OFFLINE_AFTER = 3 * HEARTBEAT_INTERVAL
+HEARTBEAT_FLUSH_INTERVAL = 30
+HEARTBEAT_LATENCY_SAMPLES = 100
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class KioskHealth:
+    # Beats only touch this in-memory table; a background thread writes last_seen/ip to the database
+    # every HEARTBEAT_FLUSH_INTERVAL in one executemany, and announces online/offline transitions.
+    def __init__(self):
+        self.beats = {}
+        self.known = set()
+        self.dirty = set()
+        self.online = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def is_known(self, kiosk_id):
+        # Only registered kiosks get an entry, so the table is bounded by the kiosk table; each id costs
+        # one primary-key read per process
+        with self.lock:
+            if kiosk_id in self.known:
+                return True
+        if db.session.get(Kiosk, kiosk_id) is None:
+            return False
+        with self.lock:
+            self.known.add(kiosk_id)
+        return True
+
+    @staticmethod
+    def parse(data):
+        # Raises ValueError before anything is recorded, so a bad beat never leaves an entry half-updated
+        latency = data.get('latency_ms')
+        latency = float(latency) if latency is not None else None
+        if latency is not None and not 0 <= latency < float('inf'):
+            raise ValueError('latency_ms must be a non-negative number')
+        queue_depth = data.get('queue_depth')
+        queue_depth = int(queue_depth) if queue_depth is not None else None
+        if queue_depth is not None and queue_depth < 0:
+            raise ValueError('queue_depth must be non-negative')
+        return latency, queue_depth, bool(data.get('error_mode'))
+
+    def record(self, kiosk_id, ip_address, data):
+        latency, queue_depth, error_mode = self.parse(data)
+        now = datetime.utcnow()
+        with self.lock:
+            entry = self.beats.setdefault(kiosk_id, {'latencies': deque(maxlen=HEARTBEAT_LATENCY_SAMPLES)})
+            entry.update(last_seen=now, ip_address=ip_address, queue_depth=queue_depth, error_mode=error_mode)
+            if latency is not None:
+                entry['latencies'].append(latency)
+            self.dirty.add(kiosk_id)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.flush_loop, daemon=True)
+                self.thread.start()
+
+    def snapshot(self, kiosk_id, db_last_seen=None):
+        with self.lock:
+            entry = self.beats.get(kiosk_id)
+            latencies = sorted(entry['latencies']) if entry else []
+            last_seen = entry['last_seen'] if entry else None
+            health = {'queue_depth': entry['queue_depth'], 'error_mode': entry['error_mode']} if entry else {'queue_depth': None, 'error_mode': None}
+        if db_last_seen and (last_seen is None or db_last_seen > last_seen):
+            last_seen = db_last_seen
+        health.update(
+            last_seen=last_seen.isoformat() if last_seen else None,
+            online=bool(last_seen and (datetime.utcnow() - last_seen).total_seconds() < KIOSK_OFFLINE_AFTER),
+            latency_p50_ms=percentile(latencies, 0.5), latency_p95_ms=percentile(latencies, 0.95), latency_p99_ms=percentile(latencies, 0.99))
+        return health
+
+    def flush_loop(self):
+        while True:
+            time.sleep(HEARTBEAT_FLUSH_INTERVAL)
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing kiosk heartbeats: {e}")
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            rows = [{'b_id': k, 'b_last_seen': self.beats[k]['last_seen'], 'b_ip_address': self.beats[k]['ip_address']} for k in dirty]
+            known = list(self.beats)
+        if rows:
+            # Under serve.py each worker sees only some of a kiosk's beats, so last_seen only ever moves forward
+            table = Kiosk.__table__
+            last_seen = db.func.max(db.func.coalesce(table.c.last_seen, bindparam('b_last_seen')), bindparam('b_last_seen'))
+            db.session.execute(table.update().where(table.c.id == bindparam('b_id')).values(last_seen=last_seen, ip_address=bindparam('b_ip_address')), rows)
+        # Transitions are decided on the database's last_seen, which every worker's beats reach, not this worker's share
+        db_last_seen = dict(db.session.query(Kiosk.id, Kiosk.last_seen).filter(Kiosk.id.in_(known)).all()) if known else {}
+        for kiosk_id in known:
+            online = self.snapshot(kiosk_id, db_last_seen.get(kiosk_id))['online']
+            if self.online.get(kiosk_id) != online:
+                self.online[kiosk_id] = online
+                kiosk = db.session.get(Kiosk, kiosk_id)
+                if kiosk:
+                    record_event('kiosk', kiosk_to_dict(kiosk))
+        db.session.commit()
+
+kiosk_health = KioskHealth()
+
+# Serialized catalog per version, so unchanged catalogs aren't re-queried or re-encoded
+catalog_cache = {}
+
+def get_version(name):
+    version = db.session.get(Version, name)
+    return version.value if version else 0
+
+def bump_version(name):
+    # Runs in the caller's transaction so the bump commits together with the change
+    version = db.session.get(Version, name)
+    if not version:
+        version = Version(name=name, value=0)
+        db.session.add(version)
+    version.value += 1
+    return version.value
+
+def catalog_etag(version):
+    return f'catalog-{version}'
+
+DEFAULT_CREDIT_LIMIT = float(os.environ['POS_DEFAULT_CREDIT_LIMIT']) if os.environ.get('POS_DEFAULT_CREDIT_LIMIT') else None
+LEDGER_CREDIT_KINDS = ('deposit', 'refund')
+LEDGER_PAGE_SIZE = 100
+
+def get_account(user_id):
+    # Created on first use, so users from before the ledger start at a zero balance
+    account = db.session.get(Account, user_id)
+    if account is None:
+        account = Account(user_id=user_id, balance=0, credit_limit=DEFAULT_CREDIT_LIMIT)
+        db.session.add(account)
+    return account
+
+def can_afford(account, amount):
+    credit_limit = account.credit_limit if account else DEFAULT_CREDIT_LIMIT
+    balance = account.balance if account else 0
+    return credit_limit is None or balance - amount >= -credit_limit - 0.005
+
+def post_ledger_entry(account, kind, amount, order_id=None, note=None):
+    # Writers hold the database lock from BEGIN IMMEDIATE, so this read-modify-write can't interleave
+    account.balance = round(account.balance + amount, 2)
+    entry = LedgerEntry(user_id=account.user_id, kind=kind, amount=amount, balance_after=account.balance, order_id=order_id, note=note)
+    db.session.add(entry)
+    return entry
+
+def account_to_dict(user_id, account):
+    credit_limit = account.credit_limit if account else DEFAULT_CREDIT_LIMIT
+    balance = account.balance if account else 0
+    return {'user_id': user_id, 'balance': balance, 'credit_limit': credit_limit,
+            'available': None if credit_limit is None else round(balance + credit_limit, 2)}
+
+def ledger_entry_to_dict(e):
+    return {'id': e.id, 'user_id': e.user_id, 'kind': e.kind, 'amount': e.amount, 'balance_after': e.balance_after, 'order_id': e.order_id, 'note': e.note, 'timestamp': e.timestamp.isoformat()}
+
+STOCK_REASONS = ('restock', 'adjustment', 'count')
+
+def is_low_stock(item):
+    return item.stock is not None and item.low_stock_threshold is not None and item.stock <= item.low_stock_threshold
+
+def stock_to_dict(i):
+    return {'id': i.id, 'name': i.name, 'sku': i.sku, 'stock': i.stock, 'low_stock_threshold': i.low_stock_threshold, 'low': is_low_stock(i)}
+
+def stock_movement_to_dict(m):
+    return {'id': m.id, 'item_id': m.item_id, 'change': m.change, 'stock_after': m.stock_after, 'reason': m.reason, 'order_id': m.order_id, 'note': m.note, 'timestamp': m.timestamp.isoformat()}
+
+def stock_changed(item, previous):
+    # Only sell-outs, restocks from zero and threshold crossings reach the catalog and dashboards,
+    # so ordinary sales don't invalidate every kiosk's cached catalog
+    if (previous is not None and previous <= 0) != (item.stock is not None and item.stock <= 0):
+        bump_version('catalog')
+        record_event('item', item_to_dict(item))
+    was_low = previous is not None and item.low_stock_threshold is not None and previous <= item.low_stock_threshold
+    if is_low_stock(item) != was_low:
+        record_event('stock', stock_to_dict(item))
+
+def take_stock(items, quantities, enforce=True):
+    # One conditional UPDATE per tracked line. The WHERE clause re-checks the level at write time, so two kiosks
+    # can't both sell the last unit; a shortfall on any line rolls back the savepoint and leaves stock untouched.
+    tracked = [(item_id, quantity) for item_id, quantity in quantities.items() if items[item_id].stock is not None]
+    levels = {}
+    if not tracked:
+        return levels
+    with db.session.begin_nested():
+        for item_id, quantity in tracked:
+            stmt = db.update(Item).where(Item.id == item_id, Item.stock.isnot(None))
+            if enforce:
+                stmt = stmt.where(Item.stock >= quantity)
+            stock = db.session.execute(stmt.values(stock=Item.stock - quantity).returning(Item.stock)).scalar()
+            if stock is None:
+                raise ValueError(f'Out of stock: {items[item_id].name}')
+            levels[item_id] = stock
+    return levels
+
+def record_stock_movements(items, quantities, levels, order_id=None):
+    db.session.add_all([StockMovement(item_id=item_id, change=-quantities[item_id], stock_after=stock, reason='sale', order_id=order_id)
+                        for item_id, stock in levels.items()])
+    for item_id, stock in levels.items():
+        items[item_id].stock = stock
+        stock_changed(items[item_id], stock + quantities[item_id])
+
+MANUAL_ITEM_ID = 0  # item_id clients send for manual/custom charges; stored as NULL
+ORDER_BATCH_LIMIT = 100
+
+def record_order(data, enforce_limits=True, principal=None):
+    # Validates fully before touching the session, so a rejected order leaves nothing behind.
+    # principal is who rang the order up; authorize_order raises PermissionError if they may not.
+    # enforce_limits=False records the order even past the user's credit limit or the stock on hand
+    # (sales that already happened offline); stock may then go negative until the next count.
+    quantities = {}
+    manual_amounts = []
+    try:
+        # Malformed entries (missing keys, nulls, wrong types) are rejections like any other, so one bad
+        # journal row can't fail a whole batch and block the kiosk's queue behind it
+        lines = data.get('items') or []
+        if not isinstance(lines, list) or not lines:
+            raise ValueError('Order has no items')
+        user_id = int(data['user_id'])
+        kiosk_id = int(data['kiosk_id']) if data.get('kiosk_id') is not None else None
+        timestamp = datetime.fromisoformat(data['timestamp']) if data.get('timestamp') else datetime.utcnow()
+        for line in lines:
+            quantity = int(line.get('quantity', 1))
+            if quantity <= 0:
+                raise ValueError('Quantity must be positive')
+            item_id = int(line.get('item_id', MANUAL_ITEM_ID))
+            if item_id == MANUAL_ITEM_ID:
+                amount = round(float(line['amount']), 2)
+                if not amount > 0:
+                    raise ValueError('Amount must be positive')
+                manual_amounts.append(amount)
+                continue
+            quantities[item_id] = quantities.get(item_id, 0) + quantity
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f'Malformed order: {type(e).__name__}: {e}')
+    authorize_order(principal, user_id, bool(manual_amounts))
+    if not db.session.get(User, user_id):
+        raise ValueError(f"Unknown user: {user_id}")
+    check_can_buy(user_id)
+    items = {i.id: i for i in Item.query.filter(Item.id.in_(quantities)).all()} if quantities else {}
+    missing = [item_id for item_id in quantities if item_id not in items]
+    if missing:
+        raise ValueError(f'Unknown items: {missing}')
+    sales = [Sale(user_id=user_id, item_id=item_id, kiosk_id=kiosk_id, quantity=quantity, total_price=round(items[item_id].price * quantity, 2), timestamp=timestamp)
+             for item_id, quantity in quantities.items()]
+    sales += [Sale(user_id=user_id, item_id=None, kiosk_id=kiosk_id, quantity=1, total_price=amount, timestamp=timestamp)
+              for amount in manual_amounts]
+    total = round(sum(sale.total_price for sale in sales), 2)
+    account = db.session.get(Account, user_id)
+    if enforce_limits and not can_afford(account, total):
+        raise ValueError('Insufficient funds')
+    levels = take_stock(items, quantities, enforce_limits)
+    order = Order(user_id=user_id, kiosk_id=kiosk_id, total_price=total, timestamp=timestamp, idempotency_key=data.get('idempotency_key'))
+    db.session.add(order)
+    db.session.flush()
+    for sale in sales:
+        sale.order_id = order.id
+    db.session.add_all(sales)
+    post_ledger_entry(account or get_account(order.user_id), 'charge', -total, order_id=order.id)
+    record_stock_movements(items, quantities, levels, order.id)
+    db.session.flush()
+    record_event('sale', {'order_id': order.id, 'user_id': order.user_id, 'kiosk_id': order.kiosk_id, 'total_price': order.total_price, 'sales': [sale_to_dict(sale) for sale in sales]})
+    return order
+
+def order_result(order):
+    return {'order_id': order.id, 'total_price': order.total_price}
+
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('POS_IDEMPOTENCY_CACHE_SIZE', 10000))
+
+class RecentOrders:
+    # idempotency key -> (user id, order result) for orders this process recorded or looked up recently, so kiosk
+    # retries and journal replays are answered without a query. The unique index on orders.idempotency_key stays
+    # the source of truth: other workers' orders are found in the database, and a racing insert fails there.
+    def __init__(self, maxsize=IDEMPOTENCY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def remember(self, order):
+        # Only call after the order is committed, so a rolled-back order is never replayed
+        entry = (order.user_id, order_result(order))
+        with self.lock:
+            self.entries[order.idempotency_key] = entry
+            self.entries.move_to_end(order.idempotency_key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry
+
+    def lookup(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+        missing = [key for key in keys if key not in found]
+        if missing:
+            for order in Order.query.filter(Order.idempotency_key.in_(missing)).all():
+                found[order.idempotency_key] = self.remember(order)
+        return found
+
+recent_orders = RecentOrders()
+
+def idempotency_key(data):
+    # Idempotency-Key header, or idempotency_key in the body as the kiosk journal sends it
+    return request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+
+def is_unique_violation(error):
+    # Only a duplicate key means the order may already exist; foreign key and other failures are bad input
+    return 'UNIQUE constraint failed' in str(error.orig)
+
+def same_buyer(user_id, data):
+    # Whether a retry is for the user the key was first used for; user_id may arrive as a string
+    try:
+        return user_id == int(data.get('user_id'))
+    except (TypeError, ValueError):
+        return False
+
+def replay_order(key, data, message):
+    # The response for a key that was already used, or None if it is new
+    entry = recent_orders.lookup([key]).get(key) if key else None
+    if entry is None:
+        return None
+    if not same_buyer(entry[0], data):
+        return jsonify({'error': 'Idempotency key was already used for a different order'}), 409
+    return jsonify({'message': message, **entry[1]})
+
+KIOSK_SESSION_TTL = 30 * 60
+JOURNAL_TOKEN_MAX_AGE = 7 * 24 * 60 * 60  # how long a kiosk's offline journal may hold a sale before syncing it
+VERIFIED_CREDENTIAL_TTL = 10 * 60
+VERIFIED_CREDENTIAL_MAX = 1024
+KIOSK_PASSWORD_FIELDS = {'kiosk': 'password_kiosk', 'kiosk_staff': 'password_kiosk', 'teacher': 'password_teacher', 'admin': 'password_admin'}
+
+# Successful (kiosk, mode, stored hash, password) checks, keyed by a keyed SHA-256 so no password is kept.
+# The stored hash is part of the key, so changing a password invalidates its entries.
+verified_credentials = {}
+
+def kiosk_token_serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='kiosk-session')
+
+def hash_password(password):
+    # Hashing takes ~100 ms. A write request holds the database-wide write lock from its first query (see
+    # begin_sqlite_transaction), so end any open transaction first; call before changing anything in the session.
+    db.session.rollback()
+    return generate_password_hash(password)
+
+def verify_kiosk_password(kiosk, mode, password):
+    field = KIOSK_PASSWORD_FIELDS[mode]
+    kiosk_id, stored_hash = kiosk.id, getattr(kiosk, field)
+    key = hmac.new(app.config['SECRET_KEY'].encode(), f'{kiosk_id}:{field}:{stored_hash}:{password}'.encode(), hashlib.sha256).hexdigest()
+    now = time.monotonic()
+    if verified_credentials.get(key, 0) > now:
+        return True
+    db.session.rollback()  # not holding the write lock while checking the hash, as in hash_password
+    if not check_password_hash(stored_hash, password):
+        return False
+    if len(verified_credentials) >= VERIFIED_CREDENTIAL_MAX:
+        for expired in [k for k, expires in list(verified_credentials.items()) if expires <= now]:
+            verified_credentials.pop(expired, None)
+        if len(verified_credentials) >= VERIFIED_CREDENTIAL_MAX:
+            verified_credentials.clear()
+    verified_credentials[key] = now + VERIFIED_CREDENTIAL_TTL
+    return True
+
+def issue_kiosk_token(kiosk_id, mode, user_id=None):
+    payload = {'kiosk_id': kiosk_id, 'mode': mode}
+    if user_id:
+        payload['user_id'] = user_id
+    return kiosk_token_serializer().dumps(payload)
+
+def verify_kiosk_token(token):
+    # Returns the token payload, or None when missing, tampered with or expired
+    if not token:
+        return None
+    try:
+        return kiosk_token_serializer().loads(token, max_age=KIOSK_SESSION_TTL)
+    except (BadSignature, SignatureExpired):
+        return None
+
+PERMISSIONS = ('sale.create', 'sale.manual', 'item.manage', 'stock.manage', 'user.manage', 'ledger.manage', 'kiosk.manage')
+ROLE_PERMISSIONS = {
+    'student': frozenset({'sale.create'}),
+    'kiosk_staff': frozenset({'sale.create'}),
+    'teacher': frozenset({'sale.create', 'sale.manual', 'stock.manage'}),
+    'admin': frozenset(PERMISSIONS),
+}
+# All an RFID tap grants, whatever the card holder's role: staff and admin sessions need the mode password
+BUYER_PERMISSIONS = frozenset({'sale.create'})
+ENFORCE_PERMISSIONS = os.environ.get('POS_ENFORCE_PERMISSIONS', '1') != '0'
+PERMISSION_CACHE_SIZE = int(os.environ.get('POS_PERMISSION_CACHE_SIZE', 4096))
+PERMISSION_CACHE_TTL = int(os.environ.get('POS_PERMISSION_CACHE_TTL', 60))
+
+class PermissionCache:
+    # user id -> effective permissions, LRU-bounded with a TTL. Changes made in this process invalidate
+    # their entry right away; changes made by other workers show up once the entry expires.
+    def __init__(self, maxsize=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, load):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                return entry[1]
+        permissions = load(user_id)
+        with self.lock:
+            self.entries[user_id] = (now + self.ttl, permissions)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return permissions
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+permission_cache = PermissionCache()
+
+def load_permissions(user_id):
+    # One query for the privilege and every Permission row
+    rows = db.session.query(User.privilege, Permission.permission).outerjoin(Permission, Permission.user_id == User.id).filter(User.id == user_id).all()
+    if not rows:
+        return frozenset()
+    overrides = [permission for _, permission in rows if permission]
+    granted = ROLE_PERMISSIONS.get(rows[0].privilege, frozenset()) | {p for p in overrides if not p.startswith('-')}
+    return frozenset(granted - {p[1:] for p in overrides if p.startswith('-')})
+
+def effective_permissions(user_id):
+    return permission_cache.get(user_id, load_permissions)
+
+def current_principal():
+    # Dashboard session (admin) or a kiosk session token, which carries the mode and, after an RFID unlock, the user
+    if 'principal' not in g:
+        if session.get('logged_in'):
+            g.principal = {'mode': 'admin'}
+        else:
+            header = request.headers.get('Authorization', '')
+            g.principal = verify_kiosk_token(header[7:]) if header.startswith('Bearer ') else None
+    return g.principal
+
+def principal_permissions(principal):
+    if principal.get('user_id'):
+        return effective_permissions(principal['user_id']) & BUYER_PERMISSIONS
+    return ROLE_PERMISSIONS.get(principal.get('mode'), frozenset())
+
+def requires_permission(permission, methods=('POST', 'PUT', 'DELETE')):
+    # Guards the write methods of a view; reads stay open so kiosks can load the catalog before unlocking
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if ENFORCE_PERMISSIONS and request.method in methods:
+                principal = current_principal()
+                if principal is None:
+                    return jsonify({'error': 'Authentication required'}), 401
+                if permission not in principal_permissions(principal):
+                    return jsonify({'error': f'Missing permission: {permission}'}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def has_permission(permission):
+    if not ENFORCE_PERMISSIONS:
+        return True
+    principal = current_principal()
+    return principal is not None and permission in principal_permissions(principal)
+
+def authorize_order(principal, user_id, manual):
+    # Selling needs sale.create, manual charges need sale.manual, and an RFID session only buys for its card holder
+    if not ENFORCE_PERMISSIONS:
+        return
+    if principal is None:
+        raise PermissionError('Authentication required')
+    permissions = principal_permissions(principal)
+    if 'sale.create' not in permissions:
+        raise PermissionError('Missing permission: sale.create')
+    if manual and 'sale.manual' not in permissions:
+        raise PermissionError('Missing permission: sale.manual')
+    if principal.get('user_id') and principal['user_id'] != user_id:
+        raise PermissionError('A card session can only buy for its card holder')
+
+def journal_principal(entry):
+    # A journaled sale carries the session token it was rung up under, honoured past the session TTL since the
+    # kiosk may have been offline, but only for a sale timestamped within that session. Entries without one fall
+    # back to whoever is sending the batch. Returns (principal, whether it was an offline sale rung up by staff).
+    if entry.get('operator_token') is None:
+        return current_principal(), False
+    try:
+        principal, issued = kiosk_token_serializer().loads(entry['operator_token'], max_age=JOURNAL_TOKEN_MAX_AGE, return_timestamp=True)
+    except (BadSignature, SignatureExpired):
+        raise PermissionError('Operator token is invalid or expired')
+    try:
+        rung_up = datetime.fromisoformat(entry['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        raise PermissionError('Journaled sale has no valid timestamp')
+    issued = issued.replace(tzinfo=None)
+    if not issued <= rung_up <= issued + timedelta(seconds=KIOSK_SESSION_TTL):
+        raise PermissionError('Sale was not rung up during its operator session')
+    # Card sessions are the buyer's own; what they ring up is checked like a live order even if it was offline
+    return principal, bool(entry.get('offline')) and not principal.get('user_id')
+
+def check_can_buy(user_id):
+    if ENFORCE_PERMISSIONS and 'sale.create' not in effective_permissions(user_id):
+        raise ValueError(f'User {user_id} may not make purchases')
+
+SALES_PAGE_SIZE = 100
+SALES_MAX_PAGE_SIZE = 1000
+SALES_EXPORT_BATCH = 1000
+
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+GZIP_MIN_BYTES = 1024
+GZIP_MIMETYPES = ('application/json', MSGPACK_MIMETYPE, 'text/html', 'text/plain')
+SALE_FIELDS = ('id', 'order_id', 'user_id', 'item_id', 'kiosk_id', 'quantity', 'total_price', 'timestamp')
+ITEM_FIELDS = ('id', 'name', 'price', 'sku', 'category', 'sold_out')
+USER_FIELDS = ('id', 'username', 'privilege', 'rfid')
+PUBLIC_USER_FIELDS = ('id', 'username', 'privilege')  # card numbers unlock kiosks, so only user.manage sees them
+BATCH_RESULT_FIELDS = ('idempotency_key', 'status', 'order_id', 'total_price', 'error')
+
+def wire_format():
+    # JSON stays the default; clients that prefer application/x-msgpack in Accept get msgpack
+    if msgpack and request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        return 'msgpack'
+    return 'json'
+
+def encode_table(fields, rows, fmt):
+    # The one place row tuples become payload: a list of objects for JSON, which existing clients expect,
+    # or column-oriented for msgpack, so field names are sent once and each column packs uniformly
+    if fmt == 'msgpack':
+        return {'columns': list(fields), 'values': [list(column) for column in zip(*rows)] if rows else [[] for _ in fields]}
+    return [dict(zip(fields, row)) for row in rows]
+
+def encode_payload(payload, fmt):
+    if fmt == 'msgpack':
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload).encode()
+
+def wire_response(payload, fmt):
+    response = Response(encode_payload(payload, fmt), mimetype=MSGPACK_MIMETYPE if fmt == 'msgpack' else 'application/json')
+    response.vary.add('Accept')
+    return response
+
+def request_payload():
+    if request.mimetype == MSGPACK_MIMETYPE:
+        if not msgpack:
+            raise ValueError('msgpack is not installed on this server')
+        return msgpack.unpackb(request.get_data(), raw=False)
+    return request.json
+
+def sale_row(s):
+    return (s.id, s.order_id, s.user_id, s.item_id, s.kiosk_id, s.quantity, s.total_price, str(s.timestamp))
+
+def sale_to_dict(s):
+    return dict(zip(SALE_FIELDS, sale_row(s)))
+
+SALE_FILTER_FIELDS = ('user_id', 'item_id', 'kiosk_id')
+
+def sale_filters(args):
+    # int() raises ValueError on junk, so a mistyped filter is a 400 rather than silently matching everything
+    filters = {field: int(args[field]) for field in SALE_FILTER_FIELDS if args.get(field)}
+    for bound in ('since', 'until'):
+        if args.get(bound):
+            filters[bound] = datetime.fromisoformat(args[bound])
+    return filters
+
+def filtered_sales(filters):
+    query = Sale.query
+    for field in SALE_FILTER_FIELDS:
+        if field in filters:
+            query = query.filter(getattr(Sale, field) == filters[field])
+    if 'since' in filters:
+        query = query.filter(Sale.timestamp >= filters['since'])
+    if 'until' in filters:
+        query = query.filter(Sale.timestamp < filters['until'])
+    return query
+
+def batched_rows(query, id_column, batch_size=SALES_EXPORT_BATCH):
+    # Keyset pagination on id so each batch is an index range scan and memory stays flat
+    last_id = 0
+    while True:
+        batch = query.filter(id_column > last_id).order_by(id_column).limit(batch_size).all()
+        if not batch:
+            return
+        yield batch
+        last_id = getattr(batch[-1], id_column.key)
+        db.session.expunge_all()
+
+def batched_sales(query, batch_size=SALES_EXPORT_BATCH):
+    return batched_rows(query, Sale.id, batch_size)
+
+def iter_sales(query, batch_size=SALES_EXPORT_BATCH):
+    for batch in batched_sales(query, batch_size):
+        yield from batch
+
+SALES_HOT_MONTHS = int(os.environ.get('POS_SALES_HOT_MONTHS', 3))  # months, including the current one, kept in pos.db
+SQLITE_TIMESTAMP = '%Y-%m-%d %H:%M:%S.%f'  # how SQLAlchemy stores DateTime columns in SQLite
+PARTITION_SCHEMA = ('CREATE TABLE IF NOT EXISTS sale (id INTEGER PRIMARY KEY, order_id INTEGER, user_id INTEGER NOT NULL, item_id INTEGER, '
+                    'kiosk_id INTEGER, quantity INTEGER NOT NULL, total_price FLOAT NOT NULL, timestamp DATETIME)')
+
+def archive_dir():
+    # Next to the database unless POS_ARCHIVE_DIR says otherwise, so it can live on slower, bigger storage
+    database = make_url(app.config['SQLALCHEMY_DATABASE_URI']).database
+    base = os.path.dirname(os.path.abspath(database)) if database and database != ':memory:' else app.instance_path
+    return os.environ.get('POS_ARCHIVE_DIR') or os.path.join(base, 'archive')
+
+def add_months(start, months):
+    index = start.year * 12 + start.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def archive_month(start):
+    # Copies the month into its partition file, then deletes only the copied ids from the hot table:
+    # sales recorded meanwhile get higher ids and stay hot until the next run. Rows are copied with
+    # INSERT OR IGNORE, so re-running after a crash between the two steps is safe.
+    until = add_months(start, 1)
+    name = start.strftime('%Y-%m')
+    bounds = {'since': start.strftime(SQLITE_TIMESTAMP), 'until': until.strftime(SQLITE_TIMESTAMP)}
+    os.makedirs(archive_dir(), exist_ok=True)
+    partition = sqlite3.connect(os.path.join(archive_dir(), f'sales-{name}.db'), timeout=30)
+    try:
+        partition.execute(PARTITION_SCHEMA)
+        for column in ('timestamp', 'user_id', 'item_id', 'kiosk_id'):
+            partition.execute(f'CREATE INDEX IF NOT EXISTS ix_sale_{column} ON sale ({column})')
+        copied, last_id = 0, None
+        rows = db.session.execute(text(f"SELECT {', '.join(SALE_FIELDS)} FROM sale WHERE timestamp >= :since AND timestamp < :until ORDER BY id"), bounds)
+        for batch in rows.partitions(SALES_EXPORT_BATCH):
+            partition.executemany(f"INSERT OR IGNORE INTO sale ({', '.join(SALE_FIELDS)}) VALUES ({', '.join('?' * len(SALE_FIELDS))})", [tuple(row) for row in batch])
+            copied += len(batch)
+            last_id = batch[-1].id
+        partition.commit()
+        count, total, min_id, max_id = partition.execute('SELECT count(*), coalesce(sum(total_price), 0), min(id), max(id) FROM sale').fetchone()
+    finally:
+        partition.close()
+    db.session.rollback()
+    if not copied:
+        return 0
+    deleted = db.session.execute(text('DELETE FROM sale WHERE timestamp >= :since AND timestamp < :until AND id <= :last_id'), {**bounds, 'last_id': last_id}).rowcount
+    if deleted != copied:
+        db.session.rollback()
+        raise RuntimeError(f'Archiving {name}: copied {copied} sales but {deleted} matched for deletion')
+    entry = db.session.get(SalePartition, name) or SalePartition(name=name, since=start, until=until)
+    entry.path = f'sales-{name}.db'
+    entry.sale_count, entry.total_price, entry.min_id, entry.max_id = count, round(total, 2), min_id, max_id
+    entry.archived_at = datetime.utcnow()
+    db.session.add(entry)
+    db.session.commit()
+    logger.info(f"Archived {copied} sales from {name}")
+    return copied
+
+def archive_sales(before=None):
+    # Moves every whole month before `before` out of the hot table; by default the last SALES_HOT_MONTHS stay.
+    # Reports read the rollup tables, which are kept, so they still cover archived months.
+    cutoff = datetime(before.year, before.month, 1) if before else add_months(datetime.utcnow(), 1 - SALES_HOT_MONTHS)
+    months = [name for (name,) in db.session.execute(text('SELECT DISTINCT substr(timestamp, 1, 7) FROM sale WHERE timestamp < :cutoff ORDER BY 1'), {'cutoff': cutoff.strftime(SQLITE_TIMESTAMP)})]
+    db.session.rollback()
+    return {name: archive_month(datetime.strptime(name, '%Y-%m')) for name in months}
+
+def overlapping_partitions(filters):
+    query = SalePartition.query.filter(SalePartition.sale_count > 0)
+    if 'since' in filters:
+        query = query.filter(SalePartition.until > filters['since'])
+    if 'until' in filters:
+        query = query.filter(SalePartition.since < filters['until'])
+    return query.all()
+
+def partition_rows(partition, filters, cursor=None, limit=None, descending=False):
+    # Sale rows (as sale_row tuples) from one archived month, read straight from its file
+    clauses, params = [], []
+    for field in SALE_FILTER_FIELDS:
+        if field in filters:
+            clauses.append(f'{field} = ?')
+            params.append(filters[field])
+    for bound, op in (('since', '>='), ('until', '<')):
+        if bound in filters:
+            clauses.append(f'timestamp {op} ?')
+            params.append(filters[bound].strftime(SQLITE_TIMESTAMP))
+    if cursor:
+        clauses.append('id < ?')
+        params.append(cursor)
+    sql = f"SELECT {', '.join(SALE_FIELDS)} FROM sale" + (' WHERE ' + ' AND '.join(clauses) if clauses else '') + ' ORDER BY id' + (' DESC' if descending else '')
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    conn = sqlite3.connect(f'file:{os.path.join(archive_dir(), partition.path)}?mode=ro', uri=True, timeout=30)
+    try:
+        for row in conn.execute(sql, params):
+            yield row[:-1] + (str(datetime.fromisoformat(row[-1])),)
+    finally:
+        conn.close()
+
+def latest_sales(filters, limit, cursor=None):
+    # Newest first across the hot table and the archive. Partitions are opened newest first and only while
+    # they overlap the time window and could still hold ids above the oldest row collected so far.
+    query = filtered_sales(filters)
+    if cursor:
+        query = query.filter(Sale.id < cursor)
+    rows = {row[0]: row for row in map(sale_row, query.order_by(Sale.id.desc()).limit(limit).all())}
+    for partition in sorted(overlapping_partitions(filters), key=lambda p: p.max_id, reverse=True):
+        if cursor and partition.min_id >= cursor:
+            continue
+        if len(rows) >= limit and partition.max_id < min(rows):
+            break
+        rows.update((row[0], row) for row in partition_rows(partition, filters, cursor, limit, descending=True))
+        rows = dict(sorted(rows.items(), reverse=True)[:limit])
+    return [rows[sale_id] for sale_id in sorted(rows, reverse=True)]
+
+def iter_sale_rows(filters):
+    # Oldest first across every overlapping partition and the hot table, one batch per source in memory
+    sources = [partition_rows(p, filters) for p in overlapping_partitions(filters)]
+    sources.append(map(sale_row, iter_sales(filtered_sales(filters))))
+    last_id = None
+    for row in heapq.merge(*sources, key=lambda row: row[0]):
+        if row[0] != last_id:
+            yield row
+        last_id = row[0]
+
+def partition_to_dict(p):
+    return {'name': p.name, 'since': p.since.isoformat(), 'until': p.until.isoformat(), 'path': p.path, 'sale_count': p.sale_count,
+            'total_price': p.total_price, 'min_id': p.min_id, 'max_id': p.max_id, 'archived_at': p.archived_at.isoformat()}
+
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_ERRORS = 100
+IMPORT_POOL_THRESHOLD = 16  # smaller chunks hash inline rather than wait on the pool
+EXPORT_FLUSH_BYTES = 64 * 1024
+USER_EXPORT_FIELDS = ('id', 'username', 'privilege', 'rfid', 'balance', 'credit_limit')
+ITEM_EXPORT_FIELDS = ('id', 'name', 'price', 'sku', 'category', 'stock', 'low_stock_threshold')
+BULK_FORMATS = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson'}
+password_pool = None
+password_pool_lock = threading.Lock()
+
+def hash_passwords(passwords):
+    # Hashing is deliberately slow and CPU-bound, so bulk imports spread it over a process pool.
+    # Spawned rather than forked: the server process has threads (event poller, heartbeat flusher).
+    global password_pool
+    if len(passwords) < IMPORT_POOL_THRESHOLD:
+        return [generate_password_hash(p) for p in passwords]
+    # multiprocessing is only needed here, so it isn't imported until the first large import
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    with password_pool_lock:
+        if password_pool is None:
+            password_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        pool = password_pool
+    try:
+        return list(pool.map(generate_password_hash, passwords, chunksize=8))
+    except BrokenProcessPool as e:
+        logger.warning(f"Password hashing pool failed ({e}); hashing inline")
+        with password_pool_lock:
+            if password_pool is pool:
+                password_pool = None
+        return [generate_password_hash(p) for p in passwords]
+
+def bulk_format(fmt, mimetype=None):
+    fmt = fmt or BULK_FORMATS.get(mimetype)
+    if fmt not in ('csv', 'ndjson'):
+        raise ValueError('format must be csv or ndjson')
+    return fmt
+
+def read_records(stream, fmt):
+    # Yields (line number, record) as the upload arrives; record is None for a line that isn't a JSON object
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    if fmt == 'csv':
+        reader = csv.DictReader(text_stream)
+        for record in reader:
+            yield reader.line_num, {k.strip(): v.strip() for k, v in record.items() if k and isinstance(v, str) and v.strip()}
+        return
+    for number, line in enumerate(text_stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+def chunked(iterable, size):
+    chunk = []
+    for value in iterable:
+        chunk.append(value)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def parse_user_record(record):
+    if record is None:
+        raise ValueError('Not a JSON object')
+    missing = [field for field in ('username', 'password', 'privilege') if not record.get(field)]
+    if missing:
+        raise ValueError(f'Missing {", ".join(missing)}')
+    credit_limit = record.get('credit_limit')
+    return {'username': str(record['username']), 'password': str(record['password']), 'privilege': str(record['privilege']),
+            'rfid': str(record['rfid']) if record.get('rfid') else None,
+            'credit_limit': None if credit_limit in (None, '') else float(credit_limit)}
+
+def parse_item_record(record):
+    if record is None:
+        raise ValueError('Not a JSON object')
+    if not record.get('name'):
+        raise ValueError('Missing name')
+    price = round(float(record.get('price', '')), 2)
+    if price < 0:
+        raise ValueError('Price must not be negative')
+    optional_int = lambda field: int(record[field]) if record.get(field) not in (None, '') else None
+    return {'name': str(record['name']), 'price': price, 'sku': str(record['sku']) if record.get('sku') else None,
+            'category': str(record['category']) if record.get('category') else None,
+            'stock': optional_int('stock'), 'low_stock_threshold': optional_int('low_stock_threshold')}
+
+def add_import_error(result, number, error):
+    result['error_count'] += 1
+    if len(result['errors']) < IMPORT_MAX_ERRORS:
+        result['errors'].append({'line': number, 'error': str(error)})
+
+def drop_existing_users(rows, result):
+    taken_usernames = {name for (name,) in db.session.query(User.username).filter(User.username.in_([row['username'] for _, row in rows]))}
+    taken_rfids = {rfid for (rfid,) in db.session.query(User.rfid).filter(User.rfid.in_([row['rfid'] for _, row in rows if row['rfid']]))}
+    kept = []
+    for number, row in rows:
+        if row['username'] in taken_usernames:
+            add_import_error(result, number, 'Username already exists')
+        elif row['rfid'] in taken_rfids:
+            add_import_error(result, number, 'RFID already assigned')
+        else:
+            kept.append((number, row))
+    return kept
+
+def import_users(records):
+    # Chunked, so memory stays flat and each chunk is validated with set-based IN queries and committed on its own
+    result = {'created': 0, 'error_count': 0, 'errors': []}
+    seen_usernames, seen_rfids = set(), set()
+    for chunk in chunked(records, IMPORT_CHUNK_SIZE):
+        rows = []
+        for number, record in chunk:
+            try:
+                row = parse_user_record(record)
+            except ValueError as e:
+                add_import_error(result, number, e)
+                continue
+            if row['username'] in seen_usernames:
+                add_import_error(result, number, 'Duplicate username in file')
+            elif row['rfid'] and row['rfid'] in seen_rfids:
+                add_import_error(result, number, 'Duplicate RFID in file')
+            else:
+                seen_usernames.add(row['username'])
+                if row['rfid']:
+                    seen_rfids.add(row['rfid'])
+                rows.append((number, row))
+        # Checked before hashing so re-running an import doesn't hash passwords it will discard, then again
+        # under the write lock for rows another writer added meanwhile; the lock isn't held while hashing
+        rows = drop_existing_users(rows, result)
+        db.session.rollback()
+        if not rows:
+            continue
+        hashes = dict(zip([number for number, _ in rows], hash_passwords([row['password'] for _, row in rows])))
+        users = [(User(username=row['username'], password=hashes[number], privilege=row['privilege'], rfid=row['rfid']), row['credit_limit'])
+                 for number, row in drop_existing_users(rows, result)]
+        if not users:
+            db.session.rollback()
+            continue
+        db.session.add_all([user for user, _ in users])
+        db.session.flush()
+        db.session.add_all([Account(user_id=user.id, balance=0, credit_limit=credit_limit if credit_limit is not None else DEFAULT_CREDIT_LIMIT) for user, credit_limit in users])
+        record_event('import', {'table': 'users', 'created': len(users)})
+        db.session.commit()
+        for user, _ in users:
+            index_user_rfid(user)
+        result['created'] += len(users)
+    return result
+
+def import_items(records):
+    result = {'created': 0, 'error_count': 0, 'errors': []}
+    seen_skus = set()
+    for chunk in chunked(records, IMPORT_CHUNK_SIZE):
+        rows = []
+        for number, record in chunk:
+            try:
+                row = parse_item_record(record)
+            except ValueError as e:
+                add_import_error(result, number, e)
+                continue
+            if row['sku'] and row['sku'] in seen_skus:
+                add_import_error(result, number, 'Duplicate SKU in file')
+                continue
+            if row['sku']:
+                seen_skus.add(row['sku'])
+            rows.append((number, row))
+        taken_skus = {sku for (sku,) in db.session.query(Item.sku).filter(Item.sku.in_([row['sku'] for _, row in rows if row['sku']]))}
+        items = []
+        for number, row in rows:
+            if row['sku'] in taken_skus:
+                add_import_error(result, number, 'SKU already assigned')
+            else:
+                items.append(Item(**row))
+        if not items:
+            db.session.rollback()
+            continue
+        db.session.add_all(items)
+        db.session.flush()
+        db.session.add_all([StockMovement(item_id=item.id, change=item.stock, stock_after=item.stock, reason='count') for item in items if item.stock is not None])
+        bump_version('catalog')
+        record_event('import', {'table': 'items', 'created': len(items)})
+        db.session.commit()
+        result['created'] += len(items)
+    return result
+
+def user_export_rows():
+    query = db.session.query(User.id, User.username, User.privilege, User.rfid, Account.balance, Account.credit_limit).outerjoin(Account, Account.user_id == User.id)
+    for batch in batched_rows(query, User.id):
+        yield from batch
+
+def item_export_rows():
+    for batch in batched_rows(db.session.query(Item.id, Item.name, Item.price, Item.sku, Item.category, Item.stock, Item.low_stock_threshold), Item.id):
+        yield from batch
+
+def export_records(rows, fields, fmt):
+    if fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps(dict(zip(fields, row))) + '\n'
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > EXPORT_FLUSH_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# rfid -> small user record, so a card tap never loads the user table
+rfid_index = {}
+rfid_index_lock = threading.Lock()
+rfid_index_loaded = False
+
+def item_row(i):
+    return (i.id, i.name, i.price, i.sku, i.category, i.stock is not None and i.stock <= 0)
+
+def item_to_dict(i):
+    return dict(zip(ITEM_FIELDS, item_row(i)))
+
+def kiosk_to_dict(k):
+    return {'id': k.id, 'name': k.name, 'status': k.status, 'ip_address': k.ip_address, **kiosk_health.snapshot(k.id, k.last_seen)}
+
+def user_row(u):
+    return (u.id, u.username, u.privilege, u.rfid)
+
+def user_to_dict(u):
+    return dict(zip(USER_FIELDS, user_row(u)))
+
+def public_user_to_dict(u):
+    return dict(zip(PUBLIC_USER_FIELDS, user_row(u)))
+
+def load_rfid_index():
+    global rfid_index_loaded
+    with rfid_index_lock:
+        if rfid_index_loaded:
+            return
+        rows = db.session.query(User.id, User.username, User.privilege, User.rfid).filter(User.rfid.isnot(None)).all()
+        rfid_index.clear()
+        rfid_index.update({r.rfid: {'id': r.id, 'username': r.username, 'privilege': r.privilege, 'rfid': r.rfid} for r in rows})
+        rfid_index_loaded = True
+
+def index_user_rfid(user, old_rfid=None):
+    with rfid_index_lock:
+        if old_rfid and rfid_index.get(old_rfid, {}).get('id') == user.id:
+            del rfid_index[old_rfid]
+        if user.rfid:
+            rfid_index[user.rfid] = user_to_dict(user)
+
+def lookup_rfid(rfid):
+    # The index only says which user to read. Every hit is confirmed with a primary-key read, because other
+    # workers may have moved the card or changed the user's privilege since this process indexed it.
+    load_rfid_index()
+    record = rfid_index.get(rfid)
+    user = db.session.get(User, record['id']) if record else None
+    if user is None or user.rfid != rfid:
+        if record:
+            with rfid_index_lock:
+                if rfid_index.get(rfid) is record:
+                    del rfid_index[rfid]
+        user = User.query.filter_by(rfid=rfid).first()
+        if user is None:
+            return None
+    index_user_rfid(user)
+    return user_to_dict(user)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_QUERY_SECONDS = float(os.environ.get('POS_SLOW_QUERY_MS', 200)) / 1000
+
+METRICS_FLUSH_INTERVAL = 5
+
+class Metrics:
+    # Counters and histograms rendered in Prometheus text format by /metrics. With a shared directory (serve.py
+    # sets one) every worker writes its totals there every METRICS_FLUSH_INTERVAL and /metrics sums all the
+    # files, so a scrape covers the whole server whichever worker answers it, as prometheus_client's
+    # multiprocess mode does. Files of exited workers are kept, so counters never go backwards.
+    def __init__(self, directory=None):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.sums = defaultdict(float)
+        self.directory = directory
+        self.thread = None
+
+    def observe_request(self, endpoint, method, status, seconds, request_bytes, response_bytes, queries, query_seconds):
+        key = (endpoint, method)
+        with self.lock:
+            self.requests[key + (status,)] += 1
+            self.latency[key][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.sums[('duration', key)] += seconds
+            self.sums[('request_bytes', key)] += request_bytes
+            self.sums[('response_bytes', key)] += response_bytes
+            self.sums[('sql_queries', key)] += queries
+            self.sums[('sql_seconds', key)] += query_seconds
+            if self.directory and self.thread is None:
+                # Started by the first request, so under gunicorn it runs in the worker rather than the master
+                self.thread = threading.Thread(target=self.flush_loop, daemon=True)
+                self.thread.start()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.save()
+            except OSError as e:
+                logger.error(f"Error writing metrics: {e}")
+
+    def save(self):
+        with self.lock:
+            state = {'requests': [list(key) + [count] for key, count in self.requests.items()],
+                     'latency': [list(key) + [counts] for key, counts in self.latency.items()],
+                     'sums': [[metric, endpoint, method, value] for (metric, (endpoint, method)), value in self.sums.items()]}
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(f'{path}.tmp', path)
+
+    def merged(self):
+        # This worker's latest totals plus every other worker's last flush
+        self.save()
+        total = Metrics()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for endpoint, method, status, count in state['requests']:
+                total.requests[(endpoint, method, status)] += count
+            for endpoint, method, counts in state['latency']:
+                total.latency[(endpoint, method)] = [a + b for a, b in zip(total.latency[(endpoint, method)], counts)]
+            for metric, endpoint, method, value in state['sums']:
+                total.sums[(metric, (endpoint, method))] += value
+        return total
+
+    def render(self):
+        source = self.merged() if self.directory else self
+        lines = ['# TYPE pos_requests_total counter']
+        with source.lock:
+            for (endpoint, method, status), count in sorted(source.requests.items()):
+                lines.append(f'pos_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+            lines.append('# TYPE pos_request_duration_seconds histogram')
+            for (endpoint, method), counts in sorted(source.latency.items()):
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'pos_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'pos_request_duration_seconds_sum{{{labels}}} {source.sums[("duration", (endpoint, method))]:.6f}')
+                lines.append(f'pos_request_duration_seconds_count{{{labels}}} {cumulative}')
+            for name in ('request_bytes', 'response_bytes', 'sql_queries', 'sql_seconds'):
+                lines.append(f'# TYPE pos_{name}_total counter')
+                for (metric, (endpoint, method)), value in sorted(source.sums.items()):
+                    if metric == name:
+                        lines.append(f'pos_{name}_total{{endpoint="{endpoint}",method="{method}"}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(os.environ.get('POS_METRICS_DIR'))
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0) + elapsed
+    if elapsed > SLOW_QUERY_SECONDS:
+        logger.warning(f"Slow query ({elapsed * 1000:.0f} ms) in {request.path if has_request_context() else 'background'}: {statement[:300]}")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(endpoint, request.method, response.status_code, time.perf_counter() - g.request_started,
+                                request.content_length or 0, response.content_length or 0, g.get('sql_queries', 0), g.get('sql_seconds', 0))
+    return response
+
+@app.after_request
+def compress_response(response):
+    # gzip for clients that accept it (requests and browsers do by default); streamed exports are left alone
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype not in GZIP_MIMETYPES or not request.accept_encodings['gzip']):
+        return response
+    body = response.get_data()
+    if len(body) >= GZIP_MIN_BYTES:
+        response.set_data(gzip.compress(body, 6))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
 
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -89,106 +1531,801 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/api/users', methods=['GET', 'POST'])
+@requires_permission('user.manage')
 def users():
     try:
         if request.method == 'POST':
             data = request.json
+            password = hash_password(data['password'])
             if User.query.filter_by(rfid=data.get('rfid')).first() and data.get('rfid'):
                 return jsonify({'error': 'RFID already assigned'}), 400
-            user = User(username=data['username'], password=generate_password_hash(data['password']), privilege=data['privilege'], rfid=data.get('rfid'))
+            user = User(username=data['username'], password=password, privilege=data['privilege'], rfid=data.get('rfid'))
             db.session.add(user)
+            db.session.flush()
+            if 'credit_limit' in data:
+                get_account(user.id).credit_limit = None if data['credit_limit'] is None else float(data['credit_limit'])
+            record_event('user', public_user_to_dict(user))
             db.session.commit()
+            index_user_rfid(user)
             return jsonify({'message': 'User created'})
-        users = User.query.all()
-        return jsonify([{'id': u.id, 'username': u.username, 'privilege': u.privilege, 'rfid': u.rfid} for u in users])
+        fmt = wire_format()
+        fields = USER_FIELDS if has_permission('user.manage') else PUBLIC_USER_FIELDS
+        return wire_response(encode_table(fields, [user_row(u)[:len(fields)] for u in User.query.all()], fmt), fmt)
     except Exception as e:
         logger.error(f"Error in users API: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/user/<int:id>', methods=['PUT'])
+@requires_permission('user.manage')
+def update_user(id):
+    try:
+        data = request.json
+        password = hash_password(data['password']) if 'password' in data else None
+        user = db.session.get(User, id)
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+        old_rfid = user.rfid
+        if data.get('rfid') and data['rfid'] != old_rfid and User.query.filter_by(rfid=data['rfid']).first():
+            return jsonify({'error': 'RFID already assigned'}), 400
+        if 'rfid' in data:
+            user.rfid = data['rfid'] or None
+        if 'privilege' in data:
+            user.privilege = data['privilege']
+        if 'password' in data:
+            user.password = password
+        if 'credit_limit' in data:
+            get_account(user.id).credit_limit = None if data['credit_limit'] is None else float(data['credit_limit'])
+        record_event('user', public_user_to_dict(user))
+        db.session.commit()
+        index_user_rfid(user, old_rfid)
+        permission_cache.invalidate(user.id)
+        return jsonify({'message': 'User updated'})
+    except Exception as e:
+        logger.error(f"Error updating user: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/users/<int:id>/permissions', methods=['GET', 'PUT'])
+@requires_permission('user.manage')
+def user_permissions(id):
+    try:
+        user = db.session.get(User, id)
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+        if request.method == 'PUT':
+            overrides = request.json.get('permissions') or []
+            unknown = [p for p in overrides if p.lstrip('-') not in PERMISSIONS]
+            if unknown:
+                return jsonify({'error': f'Unknown permissions: {unknown}'}), 400
+            Permission.query.filter_by(user_id=id).delete()
+            db.session.add_all([Permission(user_id=id, permission=p) for p in dict.fromkeys(overrides)])
+            db.session.commit()
+            permission_cache.invalidate(id)
+        overrides = [p.permission for p in Permission.query.filter_by(user_id=id).order_by(Permission.id)]
+        return jsonify({'user_id': id, 'privilege': user.privilege, 'overrides': overrides, 'effective': sorted(effective_permissions(id))})
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error in permissions API: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/users/by-rfid/<rfid>', methods=['GET'])
+def user_by_rfid(rfid):
+    try:
+        user = lookup_rfid(rfid)
+        if not user:
+            return jsonify({'error': 'Unknown RFID'}), 404
+        # The balance changes with every sale, so it is read per tap (a primary key lookup) rather than cached
+        return jsonify({**user, **account_to_dict(user['id'], db.session.get(Account, user['id']))})
+    except Exception as e:
+        logger.error(f"Error in RFID lookup: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def bulk_import(importer, name):
+    try:
+        fmt = bulk_format(request.args.get('format'), request.mimetype)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        return jsonify(importer(read_records(request.stream, fmt)))
+    except UnicodeDecodeError:
+        db.session.rollback()
+        return jsonify({'error': 'Upload must be UTF-8'}), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error importing {name}: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def bulk_export(rows, fields):
+    try:
+        fmt = bulk_format(request.args.get('format', 'ndjson'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_records(rows(), fields, fmt)), mimetype=mimetype)
+
+@app.route('/api/users/import', methods=['POST'])
+@requires_permission('user.manage')
+def users_import():
+    return bulk_import(import_users, 'users')
+
+@app.route('/api/users/export', methods=['GET'])
+@requires_permission('user.manage', methods=('GET',))
+def users_export():
+    return bulk_export(user_export_rows, USER_EXPORT_FIELDS)
+
+@app.route('/api/items/lookup/<code>', methods=['GET'])
+def item_lookup(code):
+    try:
+        item = Item.query.filter_by(sku=code).first()
+        if not item:
+            return jsonify({'error': 'Unknown code'}), 404
+        return jsonify(item_to_dict(item))
+    except Exception as e:
+        logger.error(f"Error in item lookup: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/items/search', methods=['GET'])
+def item_search():
+    try:
+        limit = min(request.args.get('limit', ITEM_SEARCH_LIMIT, type=int), SALES_MAX_PAGE_SIZE)
+        return jsonify([item_to_dict(i) for i in search_items(request.args.get('q', ''), limit)])
+    except Exception as e:
+        logger.error(f"Error in item search: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/items/stock', methods=['GET'])
+def items_stock():
+    try:
+        query = Item.query.filter(Item.stock.isnot(None))
+        if request.args.get('low'):
+            query = query.filter(Item.low_stock_threshold.isnot(None), Item.stock <= Item.low_stock_threshold)
+        return jsonify([stock_to_dict(i) for i in query.order_by(Item.stock).all()])
+    except Exception as e:
+        logger.error(f"Error listing stock: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/items/<int:id>/stock', methods=['GET', 'POST'])
+@requires_permission('stock.manage')
+def item_stock(id):
+    try:
+        item = db.session.get(Item, id)
+        if not item:
+            return jsonify({'error': 'Item not found'}), 404
+        if request.method == 'POST':
+            data = request.json
+            previous = item.stock
+            if 'low_stock_threshold' in data:
+                item.low_stock_threshold = None if data['low_stock_threshold'] is None else int(data['low_stock_threshold'])
+            movement = None
+            if 'count' in data:
+                # An absolute stock take; null stops tracking the item
+                item.stock = None if data['count'] is None else int(data['count'])
+                if item.stock is not None:
+                    movement = StockMovement(item_id=id, change=item.stock - (previous or 0), stock_after=item.stock, reason='count', note=data.get('note'))
+            elif 'change' in data:
+                change = int(data['change'])
+                reason = data.get('reason') or ('restock' if change > 0 else 'adjustment')
+                if reason not in STOCK_REASONS or change == 0:
+                    return jsonify({'error': 'change must be non-zero and reason one of restock, adjustment'}), 400
+                if (previous or 0) + change < 0:
+                    return jsonify({'error': f'Only {previous or 0} in stock'}), 400
+                item.stock = (previous or 0) + change
+                movement = StockMovement(item_id=id, change=change, stock_after=item.stock, reason=reason, note=data.get('note'))
+            if movement:
+                db.session.add(movement)
+            stock_changed(item, previous)
+            db.session.commit()
+            return jsonify({'message': 'Stock updated', **stock_to_dict(item)})
+        limit = min(request.args.get('limit', SALES_PAGE_SIZE, type=int), SALES_MAX_PAGE_SIZE)
+        query = StockMovement.query.filter(StockMovement.item_id == id)
+        cursor = request.args.get('cursor', type=int)
+        if cursor:
+            query = query.filter(StockMovement.id < cursor)
+        movements = query.order_by(StockMovement.id.desc()).limit(limit + 1).all()
+        next_cursor = movements[limit - 1].id if len(movements) > limit else None
+        return jsonify({**stock_to_dict(item), 'movements': [stock_movement_to_dict(m) for m in movements[:limit]], 'next_cursor': next_cursor})
+    except (ValueError, TypeError) as e:
+        db.session.rollback()
+        return jsonify({'error': f'Invalid stock value: {e}'}), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error in item stock API: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/items/import', methods=['POST'])
+@requires_permission('item.manage')
+def items_import():
+    return bulk_import(import_items, 'items')
+
+@app.route('/api/items/export', methods=['GET'])
+def items_export():
+    return bulk_export(item_export_rows, ITEM_EXPORT_FIELDS)
+
+@app.route('/api/users/<int:id>/balance', methods=['GET'])
+def user_balance(id):
+    try:
+        if not db.session.get(User, id):
+            return jsonify({'error': 'User not found'}), 404
+        return jsonify(account_to_dict(id, db.session.get(Account, id)))
+    except Exception as e:
+        logger.error(f"Error reading balance: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/users/<int:id>/ledger', methods=['GET', 'POST'])
+@requires_permission('ledger.manage')
+def user_ledger(id):
+    try:
+        if not db.session.get(User, id):
+            return jsonify({'error': 'User not found'}), 404
+        if request.method == 'POST':
+            data = request.json
+            kind = data.get('kind')
+            amount = round(float(data.get('amount', 0)), 2)
+            if kind in LEDGER_CREDIT_KINDS and amount <= 0:
+                return jsonify({'error': 'Amount must be positive'}), 400
+            if kind not in LEDGER_CREDIT_KINDS + ('adjustment',) or amount == 0:
+                return jsonify({'error': 'kind must be deposit, refund or adjustment with a non-zero amount'}), 400
+            order_id = data.get('order_id')
+            if order_id is not None:
+                order = db.session.get(Order, order_id)
+                if not order or order.user_id != id:
+                    return jsonify({'error': 'Order not found for this user'}), 404
+                if kind == 'refund':
+                    refunded = db.session.query(db.func.sum(LedgerEntry.amount)).filter(LedgerEntry.order_id == order_id, LedgerEntry.kind == 'refund').scalar() or 0
+                    if refunded + amount > order.total_price + 0.005:
+                        return jsonify({'error': f'Refund exceeds order total ({round(order.total_price - refunded, 2)} left)'}), 400
+            account = get_account(id)
+            entry = post_ledger_entry(account, kind, amount, order_id=order_id, note=data.get('note'))
+            db.session.commit()
+            return jsonify({'message': 'Ledger entry recorded', 'entry': ledger_entry_to_dict(entry), **account_to_dict(id, account)})
+        limit = min(request.args.get('limit', LEDGER_PAGE_SIZE, type=int), SALES_MAX_PAGE_SIZE)
+        query = LedgerEntry.query.filter(LedgerEntry.user_id == id)
+        cursor = request.args.get('cursor', type=int)
+        if cursor:
+            query = query.filter(LedgerEntry.id < cursor)
+        entries = query.order_by(LedgerEntry.id.desc()).limit(limit + 1).all()
+        next_cursor = entries[limit - 1].id if len(entries) > limit else None
+        return jsonify({'entries': [ledger_entry_to_dict(e) for e in entries[:limit]], 'next_cursor': next_cursor})
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': f'Invalid amount: {e}'}), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error in ledger API: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/api/items', methods=['GET', 'POST'])
+@requires_permission('item.manage')
 def items():
     try:
         if request.method == 'POST':
             data = request.json
-            item = Item(name=data['name'], price=data['price'])
+            sku = data.get('sku') or None
+            if sku and Item.query.filter_by(sku=sku).first():
+                return jsonify({'error': 'SKU already assigned'}), 400
+            item = Item(name=data['name'], price=data['price'], sku=sku, category=data.get('category') or None, stock=data.get('stock'), low_stock_threshold=data.get('low_stock_threshold'))
             db.session.add(item)
+            db.session.flush()
+            if item.stock is not None:
+                db.session.add(StockMovement(item_id=item.id, change=item.stock, stock_after=item.stock, reason='count'))
+            bump_version('catalog')
+            record_event('item', item_to_dict(item))
             db.session.commit()
             return jsonify({'message': 'Item added'})
-        items = Item.query.all()
-        return jsonify([{'id': i.id, 'name': i.name, 'price': i.price} for i in items])
+        version = get_version('catalog')
+        etag = catalog_etag(version)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            # Encoded (and compressed) once per catalog version and variant, not per request
+            fmt = wire_format()
+            compress = bool(request.accept_encodings['gzip'])
+            cached = catalog_cache.get((fmt, compress))
+            if not cached or cached[0] != version:
+                body = encode_payload(encode_table(ITEM_FIELDS, [item_row(i) for i in Item.query.all()], fmt), fmt)
+                compressed = compress and len(body) >= GZIP_MIN_BYTES
+                cached = (version, gzip.compress(body, 6) if compressed else body, compressed)
+                catalog_cache[(fmt, compress)] = cached
+            response = Response(cached[1], mimetype=MSGPACK_MIMETYPE if fmt == 'msgpack' else 'application/json')
+            response.vary.add('Accept')
+            if cached[2]:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'SKU already assigned'}), 400
     except Exception as e:
         logger.error(f"Error in items API: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/sales', methods=['GET', 'POST'])
+@requires_permission('sale.create')
 def sales():
     try:
         if request.method == 'POST':
             data = request.json
-            sale = Sale(user_id=data['user_id'], item_id=data['item_id'], quantity=data['quantity'], total_price=data['total_price'])
+            key = idempotency_key(data)
+            replay = replay_order(key, data, 'Sale already recorded')
+            if replay:
+                return replay
+            try:
+                user_id = int(data['user_id'])
+                item_id = int(data.get('item_id') or MANUAL_ITEM_ID)
+                quantity = int(data.get('quantity', 1))
+                total_price = round(float(data['total_price']), 2) if data.get('total_price') is not None or item_id == MANUAL_ITEM_ID else None
+            except (KeyError, TypeError, ValueError) as e:
+                return jsonify({'error': f'Malformed sale: {type(e).__name__}: {e}'}), 400
+            if quantity <= 0 or (total_price is not None and not total_price > 0):
+                return jsonify({'error': 'quantity and total_price must be positive'}), 400
+            if not db.session.get(User, user_id):
+                return jsonify({'error': f'Unknown user: {user_id}'}), 400
+            item = db.session.get(Item, item_id) if item_id != MANUAL_ITEM_ID else None
+            if item_id != MANUAL_ITEM_ID and item is None:
+                return jsonify({'error': f'Unknown item: {item_id}'}), 400
+            if item:
+                # Only manual charges (which need sale.manual) name their own amount; an item sells at its price
+                price = round(item.price * quantity, 2)
+                if total_price is not None and total_price != price:
+                    return jsonify({'error': f'total_price does not match the item price ({price})'}), 400
+                total_price = price
+            try:
+                authorize_order(current_principal(), user_id, item_id == MANUAL_ITEM_ID)
+                check_can_buy(user_id)
+            except (PermissionError, ValueError) as e:
+                return jsonify({'error': str(e)}), 403
+            account = db.session.get(Account, user_id)
+            if not can_afford(account, total_price):
+                return jsonify({'error': 'Insufficient funds'}), 400
+            try:
+                levels = take_stock({item.id: item}, {item.id: quantity}) if item else {}
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            # A keyed sale gets an order row to hold the key, so a retried POST finds it instead of charging twice
+            order = Order(user_id=user_id, total_price=total_price, idempotency_key=key) if key else None
+            if order:
+                db.session.add(order)
+                db.session.flush()
+            order_id = order.id if order else None
+            sale = Sale(order_id=order_id, user_id=user_id, item_id=item_id if item_id != MANUAL_ITEM_ID else None, quantity=quantity, total_price=total_price)
             db.session.add(sale)
+            if item:
+                record_stock_movements({item.id: item}, {item.id: quantity}, levels, order_id)
+            post_ledger_entry(account or get_account(sale.user_id), 'charge', -total_price, order_id=order_id)
+            db.session.flush()
+            record_event('sale', {'order_id': order_id, 'user_id': sale.user_id, 'kiosk_id': None, 'total_price': sale.total_price, 'sales': [sale_to_dict(sale)]})
             db.session.commit()
+            if order:
+                recent_orders.remember(order)
+                return jsonify({'message': 'Sale recorded', **order_result(order)})
             return jsonify({'message': 'Sale recorded'})
-        sales = Sale.query.all()
-        return jsonify([{'id': s.id, 'user_id': s.user_id, 'item_id': s.item_id, 'quantity': s.quantity, 'total_price': s.total_price, 'timestamp': str(s.timestamp)} for s in sales])
+        limit = min(request.args.get('limit', SALES_PAGE_SIZE, type=int), SALES_MAX_PAGE_SIZE)
+        rows = latest_sales(sale_filters(request.args), limit + 1, request.args.get('cursor', type=int))
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        fmt = wire_format()
+        return wire_response({'sales': encode_table(SALE_FIELDS, rows[:limit], fmt), 'next_cursor': next_cursor}, fmt)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid filter: {e}'}), 400
+    except IntegrityError as e:
+        db.session.rollback()
+        if not is_unique_violation(e):
+            logger.error(f"Sale rejected by the database: {e.orig}")
+            return jsonify({'error': 'Invalid sale'}), 400
+        # Another worker recorded the same key between our lookup and insert
+        return replay_order(key, data, 'Sale already recorded') or (jsonify({'error': 'Conflict'}), 409)
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error in sales API: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/sales/export', methods=['GET'])
+def export_sales():
+    try:
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in ('ndjson', 'json'):
+            return jsonify({'error': 'Unsupported format'}), 400
+        filters = sale_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid filter: {e}'}), 400
+
+    def generate():
+        try:
+            if fmt == 'json':
+                yield '['
+            first = True
+            for row in iter_sale_rows(filters):
+                line = json.dumps(dict(zip(SALE_FIELDS, row)))
+                if fmt == 'ndjson':
+                    yield line + '\n'
+                else:
+                    yield line if first else ',' + line
+                first = False
+            if fmt == 'json':
+                yield ']'
+        except Exception as e:
+            logger.error(f"Error exporting sales: {e}")
+
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+@app.route('/api/sales/archive', methods=['GET'])
+def sales_archive():
+    # Archiving itself runs from archive.py, outside a request, so copying a month never holds the write lock
+    try:
+        return jsonify([partition_to_dict(p) for p in SalePartition.query.order_by(SalePartition.since).all()])
+    except Exception as e:
+        logger.error(f"Error in sales archive API: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/orders', methods=['POST'])
+@requires_permission('sale.create')
+def orders():
+    try:
+        data = request.json
+        key = data['idempotency_key'] = idempotency_key(data)
+        replay = replay_order(key, data, 'Order already recorded')
+        if replay:
+            return replay
+        try:
+            order = record_order(data, principal=current_principal())
+        except PermissionError as e:
+            return jsonify({'error': str(e)}), 403
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        db.session.commit()
+        if key:
+            recent_orders.remember(order)
+        return jsonify({'message': 'Order recorded', **order_result(order)})
+    except IntegrityError as e:
+        db.session.rollback()
+        if not is_unique_violation(e):
+            logger.error(f"Order rejected by the database: {e.orig}")
+            return jsonify({'error': 'Invalid order'}), 400
+        return replay_order(key, data, 'Order already recorded') or (jsonify({'error': 'Conflict'}), 409)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error in orders API: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/orders/batch', methods=['POST'])
+def orders_batch():
+    # Drains kiosk offline journals: known keys come from the recent-orders cache (one query for the rest), one commit per batch
+    try:
+        try:
+            entries = request_payload().get('orders') or []
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 415
+        if len(entries) > ORDER_BATCH_LIMIT:
+            return jsonify({'error': f'At most {ORDER_BATCH_LIMIT} orders per batch'}), 400
+        if not isinstance(entries, list) or any(not isinstance(entry, dict) or not isinstance(entry.get('idempotency_key'), str) or not entry['idempotency_key'] for entry in entries):
+            return jsonify({'error': 'Every order needs an idempotency_key'}), 400
+        if ENFORCE_PERMISSIONS and current_principal() is None and any(entry.get('operator_token') is None for entry in entries):
+            # Not a rejection: the kiosk keeps these queued until it syncs under a session
+            return jsonify({'error': 'Authentication required'}), 401
+        keys = [entry['idempotency_key'] for entry in entries]
+        existing = recent_orders.lookup(keys)
+        results = []
+        recorded = []
+        for entry in entries:
+            key = entry['idempotency_key']
+            if key in existing:
+                user_id, result = existing[key]
+                if same_buyer(user_id, entry):
+                    results.append({'idempotency_key': key, 'status': 'duplicate', **result})
+                else:
+                    results.append({'idempotency_key': key, 'status': 'rejected', 'error': 'Idempotency key was already used for a different order'})
+                continue
+            try:
+                # Sales staff rang up while the kiosk couldn't reach us have already happened, so they are booked even
+                # past the credit limit or the stock on hand; anything else in a batch is checked like a live order
+                principal, offline = journal_principal(entry)
+                order = record_order(entry, enforce_limits=not offline, principal=principal)
+            except (ValueError, PermissionError) as e:
+                results.append({'idempotency_key': key, 'status': 'rejected', 'error': str(e)})
+                continue
+            existing[key] = (order.user_id, order_result(order))
+            recorded.append((len(results), order))
+            results.append(None)
+        db.session.commit()
+        for position, order in recorded:
+            recent_orders.remember(order)
+            results[position] = {'idempotency_key': order.idempotency_key, 'status': 'ok', **order_result(order)}
+        fmt = wire_format()
+        if fmt == 'json':
+            return jsonify({'results': results})
+        return wire_response({'results': encode_table(BATCH_RESULT_FIELDS, [tuple(r.get(f) for f in BATCH_RESULT_FIELDS) for r in results], fmt)}, fmt)
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Conflict, retry batch'}), 409
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error in orders batch API: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def report_range(args, default_days=30):
+    # [since, until) as dates; defaults to the last 30 days including today
+    until = date.fromisoformat(args['until']) if args.get('until') else datetime.utcnow().date() + timedelta(days=1)
+    since = date.fromisoformat(args['since']) if args.get('since') else until - timedelta(days=default_days)
+    return since, until
+
+@app.route('/api/reports/totals', methods=['GET'])
+def report_totals():
+    try:
+        since, until = report_range(request.args)
+        rows = db.session.query(ItemDailySales.day, db.func.sum(ItemDailySales.quantity), db.func.sum(ItemDailySales.total_price)) \
+            .filter(ItemDailySales.day >= since, ItemDailySales.day < until) \
+            .group_by(ItemDailySales.day).order_by(ItemDailySales.day).all()
+        days = [{'day': str(day), 'quantity': quantity, 'total_price': round(total, 2)} for day, quantity, total in rows]
+        return jsonify({'since': str(since), 'until': str(until), 'quantity': sum(d['quantity'] for d in days), 'total_price': round(sum(d['total_price'] for d in days), 2), 'days': days})
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date: {e}'}), 400
+    except Exception as e:
+        logger.error(f"Error in totals report: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/reports/top-items', methods=['GET'])
+def report_top_items():
+    try:
+        since, until = report_range(request.args)
+        limit = min(request.args.get('limit', 10, type=int), 100)
+        quantity = db.func.sum(ItemDailySales.quantity).label('quantity')
+        total = db.func.sum(ItemDailySales.total_price).label('total_price')
+        rows = db.session.query(ItemDailySales.item_id, Item.name, quantity, total) \
+            .outerjoin(Item, Item.id == ItemDailySales.item_id) \
+            .filter(ItemDailySales.day >= since, ItemDailySales.day < until) \
+            .group_by(ItemDailySales.item_id, Item.name).order_by(total.desc()).limit(limit).all()
+        return jsonify([{'item_id': item_id or None, 'name': name or 'Manual charge', 'quantity': qty, 'total_price': round(amount, 2)} for item_id, name, qty, amount in rows])
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date: {e}'}), 400
+    except Exception as e:
+        logger.error(f"Error in top items report: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/reports/user-spend', methods=['GET'])
+def report_user_spend():
+    try:
+        since, until = report_range(request.args)
+        limit = min(request.args.get('limit', 50, type=int), 1000)
+        total = db.func.sum(UserDailySales.total_price).label('total_price')
+        rows = db.session.query(UserDailySales.user_id, User.username, db.func.sum(UserDailySales.quantity), total) \
+            .join(User, User.id == UserDailySales.user_id) \
+            .filter(UserDailySales.day >= since, UserDailySales.day < until) \
+            .group_by(UserDailySales.user_id, User.username).order_by(total.desc()).limit(limit).all()
+        return jsonify([{'user_id': user_id, 'username': username, 'quantity': qty, 'total_price': round(amount, 2)} for user_id, username, qty, amount in rows])
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date: {e}'}), 400
+    except Exception as e:
+        logger.error(f"Error in user spend report: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/reports/users/<int:user_id>', methods=['GET'])
+def report_user(user_id):
+    try:
+        since, until = report_range(request.args)
+        rows = UserDailySales.query.filter(UserDailySales.user_id == user_id, UserDailySales.day >= since, UserDailySales.day < until) \
+            .order_by(UserDailySales.day).all()
+        days = [{'day': str(r.day), 'quantity': r.quantity, 'total_price': round(r.total_price, 2)} for r in rows]
+        return jsonify({'user_id': user_id, 'since': str(since), 'until': str(until), 'total_price': round(sum(d['total_price'] for d in days), 2), 'days': days})
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date: {e}'}), 400
+    except Exception as e:
+        logger.error(f"Error in user report: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/reports/kiosks/hourly', methods=['GET'])
+def report_kiosks_hourly():
+    try:
+        since, until = report_range(request.args, default_days=1)
+        query = KioskHourlySales.query.filter(KioskHourlySales.hour >= datetime.combine(since, datetime.min.time()), KioskHourlySales.hour < datetime.combine(until, datetime.min.time()))
+        kiosk_id = request.args.get('kiosk_id', type=int)
+        if kiosk_id is not None:
+            query = query.filter(KioskHourlySales.kiosk_id == kiosk_id)
+        rows = query.order_by(KioskHourlySales.hour, KioskHourlySales.kiosk_id).all()
+        return jsonify([{'hour': r.hour.isoformat(), 'kiosk_id': r.kiosk_id or None, 'sale_count': r.sale_count, 'total_price': round(r.total_price, 2)} for r in rows])
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date: {e}'}), 400
+    except Exception as e:
+        logger.error(f"Error in kiosk hourly report: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/api/kiosks', methods=['GET', 'POST'])
+@requires_permission('kiosk.manage')
 def kiosks():
     try:
         if request.method == 'POST':
             data = request.json
-            kiosk = Kiosk(name=data['name'], password_kiosk=generate_password_hash('kiosk'), password_teacher=generate_password_hash('teacher'), password_admin=generate_password_hash('admin'))
+            kiosk = Kiosk(name=data['name'], password_kiosk=hash_password('kiosk'), password_teacher=hash_password('teacher'), password_admin=hash_password('admin'))
             db.session.add(kiosk)
+            db.session.flush()
+            record_event('kiosk', kiosk_to_dict(kiosk))
             db.session.commit()
             return jsonify({'message': 'Kiosk added'})
         kiosks = Kiosk.query.all()
-        return jsonify([{'id': k.id, 'name': k.name, 'status': k.status, 'ip_address': k.ip_address} for k in kiosks])
+        return jsonify([kiosk_to_dict(k) for k in kiosks])
     except Exception as e:
         logger.error(f"Error in kiosks API: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/kiosk/<int:id>', methods=['PUT'])
+@requires_permission('kiosk.manage')
 def update_kiosk(id):
     try:
         data = request.json
+        passwords = {field: hash_password(data[field]) for field in ('password_kiosk', 'password_teacher', 'password_admin') if field in data}
         kiosk = Kiosk.query.get(id)
         if not kiosk:
             return jsonify({'error': 'Kiosk not found'}), 404
         if 'status' in data:
             kiosk.status = data['status']
-        if 'password_kiosk' in data:
-            kiosk.password_kiosk = generate_password_hash(data['password_kiosk'])
-        if 'password_teacher' in data:
-            kiosk.password_teacher = generate_password_hash(data['password_teacher'])
-        if 'password_admin' in data:
-            kiosk.password_admin = generate_password_hash(data['password_admin'])
+        for field, password in passwords.items():
+            setattr(kiosk, field, password)
         if 'ip_address' in data:
             kiosk.ip_address = data['ip_address']
+        record_event('kiosk', kiosk_to_dict(kiosk))
         db.session.commit()
         return jsonify({'message': 'Kiosk updated'})
     except Exception as e:
         logger.error(f"Error updating kiosk: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/kiosk/<int:id>/heartbeat', methods=['POST'])
+def kiosk_heartbeat(id):
+    # No database access beyond the first beat from each kiosk; see KioskHealth
+    try:
+        if not kiosk_health.is_known(id):
+            return jsonify({'error': 'Unknown kiosk'}), 404
+        data = request.get_json(silent=True)
+        kiosk_health.record(id, request.remote_addr, data if isinstance(data, dict) else {})
+        return '', 204
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f'Invalid heartbeat: {e}'}), 400
+    except Exception as e:
+        logger.error(f"Error recording heartbeat: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/kiosk/<int:id>/auth', methods=['POST'])
+def kiosk_auth(id):
+    try:
+        data = request.json
+        kiosk = db.session.get(Kiosk, id)
+        if data.get('rfid'):
+            # A card tap is the credential for buying as the card's user, and nothing more, whatever their role
+            if not kiosk:
+                return jsonify({'error': 'Kiosk not found'}), 404
+            user = lookup_rfid(data['rfid'])
+            if not user:
+                return jsonify({'error': 'Unknown RFID'}), 401
+            return jsonify({'token': issue_kiosk_token(kiosk.id, user['privilege'], user['id']), 'mode': user['privilege'], 'expires_in': KIOSK_SESSION_TTL,
+                            'permissions': sorted(effective_permissions(user['id']) & BUYER_PERMISSIONS)})
+        mode = data.get('mode')
+        if mode not in KIOSK_PASSWORD_FIELDS or not data.get('password'):
+            return jsonify({'error': 'mode and password required'}), 400
+        if not kiosk:
+            return jsonify({'error': 'Kiosk not found'}), 404
+        if not verify_kiosk_password(kiosk, mode, data['password']):
+            return jsonify({'error': 'Invalid password'}), 401
+        mode = 'kiosk_staff' if mode == 'kiosk' else mode
+        return jsonify({'token': issue_kiosk_token(id, mode), 'mode': mode, 'expires_in': KIOSK_SESSION_TTL,
+                        'permissions': sorted(ROLE_PERMISSIONS.get(mode, ()))})
+    except Exception as e:
+        logger.error(f"Error in kiosk auth: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/events', methods=['GET'])
+def events():
+    # Server-Sent Events stream of changes; reconnecting browsers resume from Last-Event-ID
+    subscriber = None
+    try:
+        last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', type=int)
+        subscriber = event_broker.subscribe()
+        if subscriber is None:
+            response = jsonify({'error': 'Too many open event streams, retry later'})
+            response.headers['Retry-After'] = str(EVENT_STREAM_RETRY)
+            return response, 503
+        replay = []
+        if last_id is not None:
+            changes = ChangeEvent.query.filter(ChangeEvent.id > last_id).order_by(ChangeEvent.id).limit(EVENT_REPLAY_LIMIT).all()
+            replay = [format_event(c) for c in changes]
+            last_id = changes[-1].id if changes else last_id
+        db.session.remove()
+    except Exception as e:
+        if subscriber is not None:
+            event_broker.unsubscribe(subscriber)
+        logger.error(f"Error opening event stream: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            yield from replay
+            while True:
+                try:
+                    entry = subscriber.get(timeout=EVENT_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if entry is None:
+                    return
+                event_id, message = entry
+                if last_id is None or event_id > last_id:
+                    yield message
+        finally:
+            event_broker.unsubscribe(subscriber)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/discover', methods=['GET'])
 def discover():
     ip = get_local_ip()
-    return jsonify({'server_ip': ip, 'port': 5000})
+    return jsonify({'server_ip': ip, 'port': 5000, 'server_id': default_server_id(), 'catalog_version': get_version('catalog')})
+
+def current_catalog_version():
+    with app.app_context():
+        return get_version('catalog')
+
+SCHEMA_REVISION = 1  # bump for schema work the models don't describe, e.g. the item search triggers
+
+def schema_fingerprint():
+    parts = [str(SCHEMA_REVISION)]
+    for table in db.metadata.sorted_tables:
+        parts.append(table.name)
+        parts += [f'{c.name} {c.type.compile(db.engine.dialect)}' for c in table.columns]
+        parts += sorted(index.name for index in table.indexes)
+    return int(hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:15], 16)
+
+def schema_is_current(fingerprint):
+    try:
+        with db.engine.connect() as conn:
+            return conn.execute(text("SELECT value FROM version WHERE name = 'schema'")).scalar() == fingerprint
+    except OperationalError:
+        return False
+
+def init_db(force=False):
+    # The full schema pass (create_all, column upgrades, search index, rollup backfill) only runs when the
+    # models changed since the last start; otherwise startup is a single query
+    global item_search_enabled
+    started = time.perf_counter()
+    with app.app_context():
+        warn_legacy_databases()
+        fingerprint = schema_fingerprint()
+        if not force and schema_is_current(fingerprint):
+            item_search_enabled = bool(db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'item_fts'")).first())
+            db.session.rollback()
+            logger.info(f"Database schema is current, checked in {(time.perf_counter() - started) * 1000:.0f} ms")
+            return
+        db.create_all()
+        upgrade_schema()
+        ensure_item_search()
+        backfill_rollups()
+        row = db.session.get(Version, 'schema') or Version(name='schema')
+        row.value = fingerprint
+        db.session.add(row)
+        db.session.commit()
+    logger.info(f"Database initialized in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+def create_app(init_schema=True):
+    # Entry point for WSGI servers (see serve.py). Configuration comes from the environment at import time;
+    # serve.py initializes the schema once in the master process and passes init_schema=False to workers.
+    if init_schema:
+        init_db()
+    return app
 
 if __name__ == '__main__':
     try:
-        with app.app_context():
-            db.create_all()
-        logger.info("Database initialized")
+        init_db()
         ip = get_local_ip()
         logger.info(f"Server starting on {ip}:5000")
         # Start discovery server in a thread
-        import threading
-        from discovery_server import discovery_server
-        threading.Thread(target=discovery_server, daemon=True).start()
-        app.run(host='0.0.0.0', port=5000)
+        threading.Thread(target=discovery_server, kwargs={'http_port': 5000, 'catalog_version': current_catalog_version}, daemon=True).start()
+        # Development server; use serve.py for production
+        app.run(host='0.0.0.0', port=5000, threaded=True)
     except Exception as e:
         logger.error(f"Failed to start server: {e}")
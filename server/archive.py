@@ -0,0 +1,28 @@
+import argparse
+import json
+import sys
+from datetime import datetime
+
+import app as pos_app
+
+# Moves closed months of sales out of pos.db into one SQLite file per month (instance/archive/sales-YYYY-MM.db,
+# or POS_ARCHIVE_DIR), recorded in the sale_partition manifest. GET /api/sales and the sales export still
+# find archived rows; reports are unaffected because they read the rollup tables. Safe to run from cron
+# while the server is up, and safe to re-run.
+#
+#   python archive.py                     # keep the last POS_SALES_HOT_MONTHS months (default 3) in pos.db
+#   python archive.py --before 2026-01-01 # archive everything before January 2026
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive closed months of POS sales')
+    parser.add_argument('--before', type=datetime.fromisoformat, help='archive whole months before this date')
+    args = parser.parse_args()
+
+    pos_app.init_db()
+    with pos_app.app.app_context():
+        archived = pos_app.archive_sales(args.before)
+        print(json.dumps({'archived': archived, 'partitions': [pos_app.partition_to_dict(p) for p in pos_app.SalePartition.query.order_by(pos_app.SalePartition.since)]}, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
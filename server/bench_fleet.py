@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+# Simulates a fleet of kiosks (plus dashboards) at lunch rush and reports per-endpoint throughput,
+# latency percentiles and SQLite lock waits. By default it drives the Flask app in-process against
+# a throwaway database; --url points it at a running server instead (lock waits are then not visible).
+#
+#   python bench_fleet.py --kiosks 20 --duration 30 --output bench.json
+#   python bench_fleet.py --compare bench.json          # run again and diff against an earlier result
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock_waits = defaultdict(list)
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def record_lock_wait(self, seconds):
+        endpoint = getattr(self.local, 'endpoint', None) or 'background'
+        with self.lock:
+            self.lock_waits[endpoint].append(seconds)
+
+    def summary(self, duration):
+        endpoints = {}
+        for endpoint in sorted(self.latencies):
+            values = sorted(self.latencies[endpoint])
+            waits = sorted(self.lock_waits.get(endpoint, []))
+            endpoints[endpoint] = {
+                'requests': len(values),
+                'errors': self.errors[endpoint],
+                'throughput_rps': round(len(values) / duration, 2),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                'lock_waits': len(waits),
+                'lock_wait_total_ms': round(sum(waits) * 1000, 2),
+                'lock_wait_p95_ms': round(percentile(waits, 0.95) * 1000, 2) if waits else 0,
+            }
+        total = sum(e['requests'] for e in endpoints.values())
+        return {'total_requests': total, 'throughput_rps': round(total / duration, 2), 'endpoints': endpoints}
+
+class InProcessTransport:
+    def __init__(self, app, recorder):
+        self.client = app.test_client()
+        self.recorder = recorder
+
+    def request(self, method, path, json_body=None, headers=None):
+        response = self.client.open(path, method=method, json=json_body, headers=headers or {})
+        return response.status_code, response.headers, response.get_json(silent=True)
+
+    def login(self, password):
+        self.client.post('/login', data={'password': password})
+
+class HttpTransport:
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, json_body=None, headers=None):
+        response = self.session.request(method, self.url + path, json=json_body, headers=headers or {}, timeout=30)
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, response.headers, body
+
+    def login(self, password):
+        self.session.post(self.url + '/login', data={'password': password}, timeout=30)
+
+def timed(recorder, transport, endpoint, method, path, **kwargs):
+    recorder.local.endpoint = endpoint
+    started = time.perf_counter()
+    try:
+        status, headers, body = transport.request(method, path, **kwargs)
+        ok = status < 400
+    except Exception:
+        status, headers, body, ok = None, {}, None, False
+    recorder.record(endpoint, time.perf_counter() - started, ok)
+    recorder.local.endpoint = None
+    return status, headers, body
+
+def kiosk_loop(kiosk_id, transport, recorder, stop, users, item_ids, think_time):
+    # Mirrors POSKiosk: card tap and session, catalog revalidation, a live multi-line order, heartbeat
+    etag = None
+    rng = random.Random(kiosk_id)
+    while not stop.is_set():
+        user = rng.choice(users)
+        timed(recorder, transport, 'GET /api/users/by-rfid', 'GET', f"/api/users/by-rfid/{user['rfid']}")
+        _, _, auth = timed(recorder, transport, 'POST /api/kiosk/auth', 'POST', f'/api/kiosk/{kiosk_id}/auth', json_body={'rfid': user['rfid']})
+        session = {'Authorization': 'Bearer ' + auth['token']} if auth and auth.get('token') else None
+        status, headers, _ = timed(recorder, transport, 'GET /api/items', 'GET', '/api/items', headers={'If-None-Match': etag} if etag else None)
+        if status == 200:
+            etag = headers.get('ETag')
+        lines = [{'item_id': item_id, 'quantity': rng.randint(1, 3)} for item_id in rng.sample(item_ids, rng.randint(1, min(6, len(item_ids))))]
+        order = {'user_id': user['id'], 'kiosk_id': kiosk_id, 'items': lines, 'idempotency_key': uuid.uuid4().hex}
+        timed(recorder, transport, 'POST /api/orders', 'POST', '/api/orders', json_body=order, headers=session)
+        timed(recorder, transport, 'POST /api/kiosk/heartbeat', 'POST', f'/api/kiosk/{kiosk_id}/heartbeat', json_body={'latency_ms': 10, 'queue_depth': 0, 'error_mode': False})
+        stop.wait(think_time * rng.uniform(0.5, 1.5))
+
+def dashboard_loop(transport, recorder, stop, interval):
+    while not stop.is_set():
+        timed(recorder, transport, 'GET /api/sales', 'GET', '/api/sales?limit=50')
+        timed(recorder, transport, 'GET /api/reports/totals', 'GET', '/api/reports/totals')
+        timed(recorder, transport, 'GET /api/kiosks', 'GET', '/api/kiosks')
+        stop.wait(interval)
+
+def seed(transport, n_users, n_items, n_kiosks, admin_password):
+    # Creating users, items and kiosks needs the dashboard's admin session
+    transport.login(admin_password)
+    for i in range(n_items):
+        transport.request('POST', '/api/items', json_body={'name': f'Item {i}', 'price': round(random.uniform(0.5, 6), 2)})
+    for i in range(n_kiosks):
+        transport.request('POST', '/api/kiosks', json_body={'name': f'Bench kiosk {i}'})
+    _, _, items = transport.request('GET', '/api/items')
+    existing = {u['rfid']: u for u in transport.request('GET', '/api/users')[2] or [] if u.get('rfid')}
+    users = []
+    for i in range(n_users):
+        rfid = f'BENCH{i:05d}'
+        if rfid not in existing:
+            transport.request('POST', '/api/users', json_body={'username': f'bench{i}', 'password': 'x', 'privilege': 'student', 'rfid': rfid})
+        users.append(rfid)
+    _, _, all_users = transport.request('GET', '/api/users')
+    by_rfid = {u['rfid']: u for u in all_users}
+    return [by_rfid[rfid] for rfid in users], [item['id'] for item in items]
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def compare(previous, current):
+    print(f"{'endpoint':32} {'rps':>16} {'p95 ms':>18} {'lock wait ms':>18}")
+    for endpoint, now in current['endpoints'].items():
+        before = previous['endpoints'].get(endpoint)
+        if not before:
+            print(f"{endpoint:32} {'(new)':>16}")
+            continue
+        print(f"{endpoint:32} {before['throughput_rps']:>7} -> {now['throughput_rps']:<7} {before['p95_ms']:>8} -> {now['p95_ms']:<8} {before['lock_wait_total_ms']:>8} -> {now['lock_wait_total_ms']:<8}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a fleet of kiosks against the POS server')
+    parser.add_argument('--kiosks', type=int, default=10)
+    parser.add_argument('--dashboards', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--think-time', type=float, default=0.05, help='average pause between a kiosk\'s checkouts, seconds')
+    parser.add_argument('--dashboard-interval', type=float, default=5)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--items', type=int, default=40)
+    parser.add_argument('--url', help='benchmark a running server instead of an in-process app')
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    parser.add_argument('--compare', help='earlier results JSON to diff against')
+    parser.add_argument('--admin-password', default='admin', help='dashboard password, used to seed users and items')
+    args = parser.parse_args()
+
+    recorder = Recorder()
+    if args.url:
+        make_transport = lambda: HttpTransport(args.url)
+    else:
+        workdir = tempfile.mkdtemp(prefix='pos-bench-')
+        os.environ['POS_DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import app as pos_app
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('BEGIN'):
+                conn.info['bench_begin'] = time.perf_counter()
+
+        @event.listens_for(Engine, 'after_cursor_execute')
+        def after_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('BEGIN IMMEDIATE'):
+                recorder.record_lock_wait(time.perf_counter() - conn.info.pop('bench_begin', time.perf_counter()))
+
+        pos_app.app.logger.disabled = True
+        pos_app.logger.setLevel('WARNING')
+        pos_app.init_db()
+        make_transport = lambda: InProcessTransport(pos_app.app, recorder)
+
+    users, item_ids = seed(make_transport(), args.users, args.items, args.kiosks, args.admin_password)
+    recorder.reset()  # drop seeding traffic
+    stop = threading.Event()
+    threads = [threading.Thread(target=kiosk_loop, args=(i + 1, make_transport(), recorder, stop, users, item_ids, args.think_time), daemon=True) for i in range(args.kiosks)]
+    threads += [threading.Thread(target=dashboard_loop, args=(make_transport(), recorder, stop, args.dashboard_interval), daemon=True) for _ in range(args.dashboards)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=30)
+    duration = time.perf_counter() - started
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'admin_password')},
+        'duration_s': round(duration, 2),
+        **recorder.summary(duration),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Measures cold-start cost in fresh interpreters: importing the server app, init_db() on a new and on an
+# existing database (the schema fast path), importing the kiosk module, and the kiosk's time to first
+# frame (needs a display; reported as null without one). Each figure is the median of --runs.
+#
+#   python bench_startup.py --output startup.json
+#   python bench_startup.py --compare startup.json      # run again and diff against an earlier result
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KIOSK_DIR = os.path.join(os.path.dirname(HERE), 'kiosk')
+
+SERVER_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.logger.setLevel('WARNING')
+app.init_db()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'init_db_ms': (time.perf_counter() - imported) * 1000}))
+'''
+
+KIOSK_PROBE = '''
+import json, time
+started = time.perf_counter()
+import kiosk
+print(json.dumps({'import_ms': (time.perf_counter() - started) * 1000}))
+'''
+
+def run_probe(args, cwd, env):
+    output = subprocess.run([sys.executable] + args, cwd=cwd, env=env, capture_output=True, text=True, timeout=120)
+    # kiosk.py logs and exits 0 when Tk can't open a display, so a missing result line counts as a failure too
+    lines = output.stdout.strip().splitlines()
+    if output.returncode != 0 or not lines or not lines[-1].startswith('{'):
+        return None
+    return json.loads(lines[-1])
+
+def median(values, key):
+    values = [v[key] for v in values if v]
+    return round(statistics.median(values), 1) if values else None
+
+def slowest_imports(cwd, env, count):
+    # Cumulative import time of each module app imports directly, from -X importtime, slowest first.
+    # Children are listed before their parent, so collect one level down and keep the batch that ends at app.
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=cwd, env=env, capture_output=True, text=True, timeout=120)
+    children, modules = [], []
+    for line in output.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = len(name) - len(name.lstrip())
+        if depth == 1:
+            modules = children if name.strip() == 'app' else modules
+            children = []
+        elif depth == 3:
+            children.append((name.strip(), round(int(cumulative) / 1000, 1)))
+    return dict(sorted(modules, key=lambda m: m[1], reverse=True)[:count])
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def compare(previous, current):
+    print(f"{'metric':28} {'before ms':>10} {'now ms':>10}")
+    for metric, now in current['metrics'].items():
+        before = previous['metrics'].get(metric)
+        print(f"{metric:28} {before if before is not None else '-':>10} {now if now is not None else '-':>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure server and kiosk startup time')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top-imports', type=int, default=10, help='how many of the slowest server imports to list')
+    parser.add_argument('--output', help='write machine-readable results to this JSON file')
+    parser.add_argument('--compare', help='earlier results JSON to diff against')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='pos-startup-')
+    env = dict(os.environ, POS_DATABASE_URL='sqlite:///' + os.path.join(workdir, 'startup.db'), POS_KIOSK_CACHE_DIR=os.path.join(workdir, 'kiosk'))
+    cold = []
+    for i in range(args.runs):
+        cold_env = dict(env, POS_DATABASE_URL='sqlite:///' + os.path.join(workdir, f'cold-{i}.db'))
+        cold.append(run_probe(['-c', SERVER_PROBE], HERE, cold_env))
+    run_probe(['-c', SERVER_PROBE], HERE, env)  # create the database the warm runs reuse
+    warm = [run_probe(['-c', SERVER_PROBE], HERE, env) for _ in range(args.runs)]
+    kiosk_import = [run_probe(['-c', KIOSK_PROBE], KIOSK_DIR, env) for _ in range(args.runs)]
+    first_frame = [run_probe(['kiosk.py'], KIOSK_DIR, dict(env, POS_KIOSK_STARTUP_PROBE='1')) for _ in range(args.runs)]
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': args.runs,
+        'metrics': {
+            'server_import_ms': median(warm + cold, 'import_ms'),
+            'server_init_db_new_ms': median(cold, 'init_db_ms'),
+            'server_init_db_existing_ms': median(warm, 'init_db_ms'),
+            'kiosk_import_ms': median(kiosk_import, 'import_ms'),
+            'kiosk_first_frame_ms': median(first_frame, 'first_frame_ms'),
+        },
+        'slowest_server_imports_ms': slowest_imports(HERE, env, args.top_imports),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import sys
+
+# Bulk import/export of users and items, as CSV or NDJSON (picked from the file extension or --format).
+# Runs against the local database by default; --url sends the file to a running server instead.
+#
+#   python bulk.py import users students.csv
+#   python bulk.py export items menu.ndjson --url http://server:5000
+#
+# CSV columns: users need username,password,privilege and may have rfid,credit_limit; items need name,price.
+
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def file_format(path, fmt):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    fmt = 'ndjson' if fmt in ('jsonl', 'json') else fmt
+    if fmt not in MIMETYPES:
+        raise SystemExit(f"Can't tell the format of {path}; pass --format csv or --format ndjson")
+    return fmt
+
+def run_local(args, fmt):
+    import app as pos_app
+    pos_app.init_db()
+    with pos_app.app.app_context():
+        if args.action == 'import':
+            importer = pos_app.import_users if args.table == 'users' else pos_app.import_items
+            with open(args.path, 'rb') as f:
+                return importer(pos_app.read_records(f, fmt))
+        rows, fields = (pos_app.user_export_rows, pos_app.USER_EXPORT_FIELDS) if args.table == 'users' else (pos_app.item_export_rows, pos_app.ITEM_EXPORT_FIELDS)
+        with open(args.path, 'w', newline='') as f:
+            for chunk in pos_app.export_records(rows(), fields, fmt):
+                f.write(chunk)
+
+def run_remote(args, fmt):
+    import requests
+    session = requests.Session()
+    # Imports need the dashboard's admin session
+    session.post(f"{args.url.rstrip('/')}/login", data={'password': args.admin_password}, timeout=(5, 30)).raise_for_status()
+    url = f"{args.url.rstrip('/')}/api/{args.table}/{args.action}?format={fmt}"
+    if args.action == 'import':
+        with open(args.path, 'rb') as f:
+            # A file object is streamed, so large files are never held in memory
+            response = session.post(url, data=f, headers={'Content-Type': MIMETYPES[fmt]}, timeout=(5, None))
+        response.raise_for_status()
+        return response.json()
+    with session.get(url, stream=True, timeout=(5, 60)) as response:
+        response.raise_for_status()
+        with open(args.path, 'wb') as f:
+            for chunk in response.iter_content(64 * 1024):
+                f.write(chunk)
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import/export of POS users and items')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('table', choices=('users', 'items'))
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=tuple(MIMETYPES))
+    parser.add_argument('--url', help='server to import into / export from instead of the local database')
+    parser.add_argument('--admin-password', default='admin', help='dashboard password, used with --url')
+    args = parser.parse_args()
+
+    fmt = file_format(args.path, args.format)
+    result = run_remote(args, fmt) if args.url else run_local(args, fmt)
+    if args.action == 'export':
+        print(f"Exported {args.table} to {args.path}")
+        return 0
+    print(json.dumps(result, indent=2))
+    return 1 if result['error_count'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,99 @@
+import asyncio
+import json
+import logging
+import os
 import socket
-import threading
+import sqlite3
 import time
 
-def discovery_server():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(("", 5001))
-    print("Discovery server listening on port 5001")
-    while True:
-        data, addr = sock.recvfrom(1024)
-        if data == b"DISCOVER_POS_SERVER":
-            sock.sendto(b"POS_SERVER_HERE", addr)
-            print(f"Responded to discovery from {addr}")
+logger = logging.getLogger(__name__)
+
+DISCOVERY_PORT = 5001
+LEGACY_REQUEST = b"DISCOVER_POS_SERVER"
+LEGACY_REPLY = b"POS_SERVER_HERE"
+DISCOVERY_REQUEST = b"DISCOVER_POS_SERVER v2"
+RATE_LIMIT_BURST = 5  # replies a single source can get back to back
+RATE_LIMIT_PER_SEC = 1.0
+RATE_LIMIT_MAX_SOURCES = 4096
+CATALOG_VERSION_TTL = 5
+
+def default_server_id():
+    return os.environ.get('POS_SERVER_ID') or socket.gethostname()
+
+def sqlite_catalog_version(db_path):
+    # Used when running standalone, so this process never has to import the Flask app
+    def read():
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=1)
+        try:
+            row = conn.execute("SELECT value FROM version WHERE name = 'catalog'").fetchone()
+            return row[0] if row else 0
+        finally:
+            conn.close()
+    return read
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, http_port, server_id, catalog_version=None):
+        self.http_port = http_port
+        self.server_id = server_id
+        self.catalog_version = catalog_version
+        self.cached_version = (None, 0)
+        self.buckets = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def allow(self, ip):
+        # Token bucket per source address, so a boot storm or a looping client can't flood replies
+        now = time.monotonic()
+        tokens, last = self.buckets.get(ip, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * RATE_LIMIT_PER_SEC)
+        if len(self.buckets) >= RATE_LIMIT_MAX_SOURCES and ip not in self.buckets:
+            self.buckets.clear()
+        if tokens < 1:
+            self.buckets[ip] = (tokens, now)
+            return False
+        self.buckets[ip] = (tokens - 1, now)
+        return True
+
+    def current_catalog_version(self):
+        value, expires = self.cached_version
+        if self.catalog_version and time.monotonic() >= expires:
+            try:
+                value = self.catalog_version()
+            except Exception as e:
+                logger.warning(f"Could not read catalog version: {e}")
+            self.cached_version = (value, time.monotonic() + CATALOG_VERSION_TTL)
+        return value
+
+    def datagram_received(self, data, addr):
+        if data not in (LEGACY_REQUEST, DISCOVERY_REQUEST) or not self.allow(addr[0]):
+            return
+        if data == LEGACY_REQUEST:
+            reply = LEGACY_REPLY
+        else:
+            reply = LEGACY_REPLY + b' ' + json.dumps({
+                'port': self.http_port,
+                'server_id': self.server_id,
+                'catalog_version': self.current_catalog_version()
+            }).encode()
+        self.transport.sendto(reply, addr)
+        logger.debug(f"Responded to discovery from {addr}")
+
+async def serve(port, http_port, server_id, catalog_version):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DiscoveryProtocol(http_port, server_id, catalog_version), local_addr=('0.0.0.0', port))
+    logger.info(f"Discovery server listening on port {port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+
+def discovery_server(port=DISCOVERY_PORT, http_port=5000, server_id=None, catalog_version=None):
+    asyncio.run(serve(port, http_port, server_id or default_server_id(), catalog_version))
 
 if __name__ == '__main__':
-    threading.Thread(target=discovery_server, daemon=True).start()
-    # Keep running
-    while True:
-        time.sleep(1)
+    logging.basicConfig(level=logging.INFO)
+    db_path = os.environ.get('POS_DATABASE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'pos.db'))
+    discovery_server(http_port=int(os.environ.get('POS_HTTP_PORT', 5000)), catalog_version=sqlite_catalog_version(db_path))
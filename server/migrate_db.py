@@ -0,0 +1,73 @@
+import os
+import shutil
+import sqlite3
+import sys
+from datetime import datetime
+
+from app import app, db, upgrade_schema, LEGACY_DATABASES
+
+# Merges the old split databases (pos.db, users.db, items.db, permissions.db) into a single pos.db.
+# The old files are moved to instance/legacy-<timestamp>/ and left untouched there.
+
+def copy_tables(conn, alias, path):
+    conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+    copied = {}
+    try:
+        tables = [row[0] for row in conn.execute(f"SELECT name FROM {alias}.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            target_columns = [row[1] for row in conn.execute(f'PRAGMA main.table_info("{table}")')]
+            if not target_columns:
+                print(f"  skipping {table}: not part of the current schema")
+                continue
+            source_columns = {row[1] for row in conn.execute(f'PRAGMA {alias}.table_info("{table}")')}
+            columns = ', '.join(f'"{c}"' for c in target_columns if c in source_columns)
+            cursor = conn.execute(f'INSERT OR IGNORE INTO main."{table}" ({columns}) SELECT {columns} FROM {alias}."{table}"')
+            copied[table] = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.execute(f"DETACH DATABASE {alias}")
+    return copied
+
+def migrate():
+    instance = app.instance_path
+    sources = [name for name in ('pos.db',) + LEGACY_DATABASES if os.path.exists(os.path.join(instance, name))]
+    if not any(name in sources for name in LEGACY_DATABASES):
+        print(f"No split databases found in {instance}; nothing to migrate")
+        return 0
+
+    backup_dir = os.path.join(instance, f"legacy-{datetime.now().strftime('%Y%m%d%H%M%S')}")
+    os.makedirs(backup_dir)
+    for name in sources:
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(os.path.join(instance, name + suffix)):
+                shutil.move(os.path.join(instance, name + suffix), os.path.join(backup_dir, name + suffix))
+    print(f"Moved {sources} to {backup_dir}")
+
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+        db.engine.dispose()
+
+    conn = sqlite3.connect(os.path.join(instance, 'pos.db'))
+    try:
+        # Legacy rows are copied as-is and checked afterwards, so one orphan doesn't abort the merge
+        conn.execute('PRAGMA foreign_keys=OFF')
+        for i, name in enumerate(sources):
+            copied = copy_tables(conn, f'legacy{i}', os.path.join(backup_dir, name))
+            for table, count in copied.items():
+                print(f"  {name}: copied {count} rows into {table}")
+        # Manual charges used item_id 0 as a placeholder; that is NULL now that item ids are real foreign keys
+        conn.execute('UPDATE sale SET item_id = NULL WHERE item_id = 0')
+        # Make the next server start run the full schema pass (search index, rollups) over the merged rows
+        conn.execute("DELETE FROM version WHERE name = 'schema'")
+        conn.commit()
+        orphans = conn.execute('PRAGMA foreign_key_check').fetchall()
+        if orphans:
+            print(f"Warning: {len(orphans)} rows reference missing users/items/orders, e.g. {orphans[:5]}")
+    finally:
+        conn.close()
+    print(f"Merged into {os.path.join(instance, 'pos.db')}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(migrate())
@@ -0,0 +1,123 @@
+import argparse
+import atexit
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from sqlalchemy.engine import make_url
+
+import app as pos_app
+
+logger = logging.getLogger(__name__)
+
+# Production launcher: gunicorn workers (waitress threads where gunicorn isn't available, e.g. Windows)
+# plus the discovery responder in its own supervised process.
+#
+# SQLite allows one writer at a time however many workers there are. Write requests take the lock
+# up front with BEGIN IMMEDIATE and wait on busy_timeout (see app.begin_sqlite_transaction), so extra
+# workers add read throughput and queue writes instead of failing them. A few workers with several
+# threads each is the sweet spot.
+#
+# Each open /api/events stream holds one of its worker's threads for as long as the dashboard tab stays
+# open. A worker serves at most --event-streams of them (default half its threads) and answers 503 with
+# Retry-After beyond that, so dashboards can't starve kiosk requests; the dashboard retries, usually
+# landing on another worker. Total dashboard capacity is roughly workers x event streams.
+#
+# /metrics is answered by whichever worker accepts the scrape, so the workers share their totals through
+# --metrics-dir (see app.Metrics) and every scrape reports the whole server. The directory is emptied at
+# startup, which Prometheus sees as an ordinary counter reset.
+
+DISCOVERY_RESTART_DELAY = 1
+DISCOVERY_MAX_RESTART_DELAY = 60
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the POS server in production mode')
+    parser.add_argument('--bind', default=os.environ.get('POS_BIND', '0.0.0.0:5000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('POS_WORKERS', min(4, os.cpu_count() or 1))))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('POS_THREADS', 8)))
+    parser.add_argument('--event-streams', type=int, default=int(os.environ['POS_EVENT_STREAMS']) if os.environ.get('POS_EVENT_STREAMS') else None,
+                        help='open /api/events streams per worker (default: half of --threads)')
+    parser.add_argument('--metrics-dir', default=os.environ.get('POS_METRICS_DIR'),
+                        help='directory the workers share their /metrics totals through (default: instance/metrics)')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('POS_WORKER_TIMEOUT', 60)))
+    parser.add_argument('--no-discovery', action='store_true', default=os.environ.get('POS_DISCOVERY', '1') == '0')
+    args = parser.parse_args()
+    if args.event_streams is None:
+        args.event_streams = max(1, args.threads // 2)
+    return args
+
+def supervise_discovery(http_port):
+    # Runs discovery_server.py as its own process and restarts it with backoff if it dies.
+    # A subprocess rather than multiprocessing, because the gunicorn arbiter reaps any child of the master.
+    env = dict(os.environ, POS_HTTP_PORT=str(http_port), POS_DATABASE_PATH=make_url(pos_app.app.config['SQLALCHEMY_DATABASE_URI']).database)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery_server.py')
+    delay = DISCOVERY_RESTART_DELAY
+    while True:
+        started = time.monotonic()
+        process = subprocess.Popen([sys.executable, script], env=env)
+        atexit.register(process.terminate)
+        process.wait()
+        atexit.unregister(process.terminate)
+        if time.monotonic() - started > DISCOVERY_MAX_RESTART_DELAY:
+            delay = DISCOVERY_RESTART_DELAY
+        logger.error(f"Discovery server exited with code {process.returncode}, restarting in {delay}s")
+        time.sleep(delay)
+        delay = min(delay * 2, DISCOVERY_MAX_RESTART_DELAY)
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class POSApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', args.bind)
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('keepalive', 5)
+
+        def load(self):
+            # Loaded in each worker after the fork, so no engine or thread is shared with the master
+            pos_app.event_broker.limit = args.event_streams
+            return pos_app.create_app(init_schema=False)
+
+    POSApplication().run()
+
+def run_waitress(args):
+    from waitress import serve
+    host, port = args.bind.rsplit(':', 1)
+    logger.warning("gunicorn not available; serving with waitress in a single process")
+    pos_app.event_broker.limit = args.event_streams * args.workers
+    serve(pos_app.create_app(init_schema=False), host=host, port=int(port), threads=args.threads * args.workers)
+
+def setup_metrics_dir(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(directory, name))
+    # Set before the workers fork so they all inherit it
+    pos_app.metrics.directory = directory
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    pos_app.init_db()
+    with pos_app.app.app_context():
+        # Workers open their own connections after forking
+        pos_app.db.engine.dispose()
+    setup_metrics_dir(args.metrics_dir or os.path.join(pos_app.app.instance_path, 'metrics'))
+    if not args.no_discovery:
+        threading.Thread(target=supervise_discovery, args=(int(args.bind.rsplit(':', 1)[1]),), daemon=True).start()
+    logger.info(f"Serving on {args.bind} with {args.workers} workers x {args.threads} threads, up to {args.event_streams} event streams each")
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        run_waitress(args)
+    else:
+        run_gunicorn(args)
+
+if __name__ == '__main__':
+    main()